@@ -0,0 +1,53 @@
+import os
+import resource
+
+
+def _open_fds():
+    """Return the number of file descriptors open in this process (Linux), or a small estimate elsewhere"""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 16
+
+
+class AdmissionControl:
+    """Limits accepted connections to what the RLIMIT_NOFILE file descriptor budget allows.
+
+    Load is counted in descriptors, sockets and splice pipes, as in Connector.load. A new connection is
+    admitted if fds_per_connection more descriptors, its own socket, the upstream connection it will open
+    and any pipes between them, fit below the limit less reserve. reserve keeps descriptors back for
+    upstream connects of clients still in their handshake. When a connection does not fit, the connector
+    either stops accepting until usage falls to resume_fraction of the budget, or with shed set, accepts it
+    and closes it straight away after sending the protocol factory's overload_response, so clients fail fast
+    rather than wait.
+    """
+
+    def __init__(self, fds_per_connection=2, reserve=64, resume_fraction=0.9, shed=False, limit=None):
+        """Arguments:
+        fds_per_connection -- descriptors used by each connection and the upstream connection it opens.
+                              6 with splice, which adds a pipe, of two descriptors, in each direction
+        reserve -- descriptors kept free for upstream connects and the rest of the process
+        resume_fraction -- fraction of the budget usage must fall to before accepting again
+        shed -- reject connections that do not fit rather than leaving them in the listen queue
+        limit -- descriptor limit. Defaults to the soft RLIMIT_NOFILE
+        """
+        if limit is None:
+            limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+            if limit == resource.RLIM_INFINITY:
+                limit = 1 << 20
+        self.fds_per_connection = fds_per_connection
+        self.shed = shed
+        self.limit = limit
+        # Descriptors available to connections, less those already open such as the selector and log files
+        self.budget = limit - reserve - _open_fds()
+        self._resume_level = int(self.budget * resume_fraction)
+        self.paused = 0         # Number of times accepting was paused
+        self.rejected = 0       # Number of connections shed
+
+    def admit(self, load):
+        """True if a new connection fits, with load descriptors used by connections"""
+        return load + self.fds_per_connection <= self.budget
+
+    def can_resume(self, load):
+        """True if accepting can start again after being paused"""
+        return load <= self._resume_level
@@ -0,0 +1,269 @@
+import asyncio
+import collections
+import logging
+import selectors
+import functools
+import socket
+from dns_cache import DnsCache
+from happy_eyeballs import interleave
+from resolver import ResolverPool
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger(__name__)
+
+
+class _TransportSocket:
+    """Stands in for the socket of a Protocol run by AsyncioConnector.
+    Sends go straight to the asyncio transport, which buffers what the network will not take yet"""
+
+    __slots__ = ("transport", "task", "error", "handler")
+
+    def __init__(self, transport=None):
+        self.transport = transport      # None until connected
+        self.task = None                # Task running create_connection for client connections
+        self.error = None               # Exception raised if the connection could not be made
+        self.handler = None             # Protocol event handler registered while waiting for the connection
+
+    def fileno(self):
+        sock = self.transport.get_extra_info("socket") if self.transport is not None else None
+        return sock.fileno() if sock is not None else -1
+
+    def send(self, data):
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionResetError("Transport is closed")
+        self.transport.write(data)
+        return len(data)
+
+    def getpeername(self):
+        if self.transport is None:
+            raise self.error if isinstance(self.error, OSError) else OSError(f"Not connected: {self.error}")
+        return self.transport.get_extra_info("peername")[:2]
+
+    def getsockname(self):
+        if self.transport is None:
+            raise OSError("Not connected")
+        return self.transport.get_extra_info("sockname")[:2]
+
+    def close(self):
+        if self.transport is not None:
+            # Buffered data is written before the connection closes
+            self.transport.close()
+        elif self.task is not None:
+            self.task.cancel()
+
+    def connect_done(self, task):
+        """Called when create_connection finishes. Reports a failed connection to the protocol"""
+        if task.cancelled():
+            return
+        self.error = task.exception()
+        if self.error is not None and self.handler is not None:
+            self.handler(self, selectors.EVENT_WRITE)
+
+
+class _TransportSelector:
+    """Stands in for the selector of a Protocol run by AsyncioConnector.
+    Write interest before the connection is made waits for the connection, as it does with a socket.
+    Read interest pauses and resumes reading on the transport"""
+
+    def register(self, sock, events, data=None):
+        sock.handler = data
+        self.modify(sock, events, data)
+
+    def modify(self, sock, events, data=None):
+        if sock.transport is None:
+            return
+        if events & selectors.EVENT_READ:
+            sock.transport.resume_reading()
+        else:
+            sock.transport.pause_reading()
+        if events & selectors.EVENT_WRITE and sock.handler is not None:
+            handler = sock.handler
+            sock.handler = None
+            handler(sock, selectors.EVENT_WRITE)
+
+    def unregister(self, sock):
+        sock.handler = None
+        if sock.transport is not None and not sock.transport.is_closing():
+            sock.transport.pause_reading()
+
+
+class _AsyncioProtocol(asyncio.Protocol):
+    """asyncio protocol that passes transport events on to a Protocol"""
+
+    def __init__(self, connector, protocol, sock):
+        self._connector = connector
+        self._protocol = protocol
+        self._sock = sock
+
+    def connection_made(self, transport):
+        # The Protocol decides when to read, once it is connected
+        transport.pause_reading()
+        transport.set_write_buffer_limits(self._protocol._write_buffer_high, self._protocol._write_buffer_low)
+        self._sock.transport = transport
+        if self._sock.handler is None:
+            # Server connection
+            self._protocol._connection_created(self._connector, self._connector.selector, self._sock)
+        else:
+            # Client connection waiting for write interest
+            self._connector.selector.modify(self._sock, selectors.EVENT_WRITE)
+
+    def data_received(self, data):
+        protocol = self._protocol
+        if protocol._state.reading:
+            protocol._bytes_received += len(data)
+            protocol.data_received(data)
+
+    def connection_lost(self, exc):
+        self._protocol._close(self._sock)
+
+    def pause_writing(self):
+        self._protocol._writing_paused = True
+        self._protocol.pause_writing()
+
+    def resume_writing(self):
+        self._protocol._writing_paused = False
+        self._protocol.resume_writing()
+
+
+class AsyncioConnector:
+    """Runs Protocol instances on an asyncio event loop, or on uvloop if it is installed.
+
+    Provides the parts of the Connector interface used by protocols: create_server, create_client,
+    getaddrinfo, gethostbyname, call_later, call_soon_threadsafe and start. Protocols run unchanged. Each
+    connection gets a stand in socket and selector that map Protocol's writes, read interest and close onto
+    an asyncio transport, which does the buffering and flow control. Splice is not available.
+    """
+
+    BACKENDS = ("asyncio", "uvloop")
+
+    # Protocols write straight to the transport and never read from a socket themselves
+    coalescing = False
+    edge_triggered = False
+
+    def __init__(self, backend="asyncio", resolver=None, connect_attempt_delay=0.25):
+        """Arguments:
+        backend -- "asyncio" for the standard library event loop or "uvloop" for uvloop
+        resolver -- a ResolverPool for getaddrinfo. None for a pool of this connector's own
+        connect_attempt_delay -- seconds create_client waits for a connection to one address of a host before
+                                 also trying the next
+        """
+        if backend == "asyncio":
+            self.loop = asyncio.new_event_loop()
+        elif backend == "uvloop" and uvloop is not None:
+            self.loop = uvloop.new_event_loop()
+        else:
+            raise ValueError(f"Unsupported backend: {backend}")
+        self.selector = _TransportSelector()
+        self.connections = 0            # Number of connections owned by protocols of this connector
+        self.resolver = resolver if resolver is not None else ResolverPool()
+        self.connect_attempt_delay = connect_attempt_delay
+
+    def create_client(self, addr, port, protocol, on_failure=None):
+        """Create a network client. See Connector.create_client"""
+        sock = _TransportSocket()
+        protocol._connection_created(self, self.selector, sock, on_failure)
+        if isinstance(addr, list):
+            connection = self._race(addr, port, lambda: _AsyncioProtocol(self, protocol, sock))
+        else:
+            connection = self.loop.create_connection(lambda: _AsyncioProtocol(self, protocol, sock), addr, port)
+        sock.task = self.loop.create_task(connection)
+        sock.task.add_done_callback(sock.connect_done)
+
+    async def _race(self, addresses, port, protocol_factory):
+        """Connect to the first of addresses to answer, as ConnectionRace does, and start a transport on it.
+        A new attempt starts every connect_attempt_delay seconds while earlier ones are still connecting,
+        or straight away when one fails"""
+        if not addresses:
+            raise OSError("No addresses to connect to")
+        addresses = collections.deque(interleave(addresses))
+        attempts = set()
+        sock = error = None
+        try:
+            while sock is None and (addresses or attempts):
+                if addresses:
+                    attempts.add(self.loop.create_task(self._attempt(addresses.popleft(), port)))
+                delay = self.connect_attempt_delay if addresses else None
+                done, attempts = await asyncio.wait(attempts, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif sock is None:
+                        sock = task.result()
+                    else:
+                        # Another attempt connected at the same time
+                        task.result().close()
+        finally:
+            for task in attempts:
+                task.cancel()
+        if sock is None:
+            raise error
+        return await self.loop.create_connection(protocol_factory, sock=sock)
+
+    async def _attempt(self, addr, port):
+        """Return a socket connected to addr and port"""
+        sock = socket.socket(socket.AF_INET6 if ":" in addr else socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            await self.loop.sock_connect(sock, (addr, port))
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def create_server(self, interface, port, protocol_factory, reuse_port=False, loops=None, backlog=socket.SOMAXCONN,
+                      admission=None, sock=None):
+        """Create a server for processing network events. Returns the listening socket. See Connector.create_server.
+        loops and admission are not supported: asyncio runs one loop per connector and accepts every connection"""
+        if loops is not None:
+            raise ValueError("AsyncioConnector does not share connections between loops")
+        if admission is not None:
+            raise ValueError("AsyncioConnector does not support admission control")
+        if sock is not None:
+            # asyncio takes either a listening socket or an address to bind
+            interface = port = None
+        server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: _AsyncioProtocol(self, protocol_factory.create(), _TransportSocket()),
+            interface, port, reuse_port=reuse_port or None, backlog=backlog, sock=sock,
+        ))
+        return server.sockets[0]
+
+    def getaddrinfo(self, hostname, callback):
+        """Look up hostname in the resolver's thread pool. See Connector.getaddrinfo"""
+        addresses = self.resolver.cached(hostname)
+        if addresses is not DnsCache.MISS:
+            callback(addresses or [])
+            return
+        if not self.resolver.submit(hostname, functools.partial(self.loop.call_soon_threadsafe, callback)):
+            self.loop.call_soon(callback, [])
+
+    def gethostbyname(self, hostname, callback):
+        """Look up the IPv4 address of hostname. See Connector.gethostbyname"""
+        self.getaddrinfo(hostname, lambda addresses: callback(next((a for a in addresses if ":" not in a), None)))
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds. Returns a handle whose cancel method stops the call"""
+        return self.loop.call_later(delay, callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Call callback(*args) on the loop thread as soon as possible. May be called from any thread"""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stats(self):
+        """Return a dictionary of connector statistics. Event loop timings are not recorded"""
+        return {"connections": self.connections, "resolver": self.resolver.stats()}
+
+    def start(self):
+        """Starts processing network events, until stop is called"""
+        self.loop.run_forever()
+
+    def stop(self):
+        """Make start return. May be called from any thread"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def shutdown(self):
+        logger.debug("Shutting down")
+        self.loop.close()
@@ -0,0 +1,879 @@
+import argparse
+import functools
+import multiprocessing
+import os
+import resource
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from connector import Connector
+from dns_cache import DnsCache
+from dns_client import DnsClient
+from loop_stats import LoopStats
+from protocol import Protocol
+from resolver import ResolverPool
+from send_queue import SendQueue
+from stand_in_dns import free_port, start_dns_server
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+
+class _PartialSocket:
+    """Stand-in socket that accepts at most send_size bytes per call"""
+    def __init__(self, send_size):
+        self._send_size = send_size
+
+    def send(self, data):
+        return min(len(data), self._send_size)
+
+    def sendmsg(self, buffers):
+        return min(sum(len(b) for b in buffers), self._send_size)
+
+
+def _recv_exactly(sock, n_bytes):
+    data = bytearray()
+    while len(data) < n_bytes:
+        chunk = sock.recv(n_bytes - len(data))
+        if len(chunk) == 0:
+            raise ConnectionError("Connection closed")
+        data.extend(chunk)
+    return data
+
+
+def _source_server(port):
+    """Start a server that sends the number of bytes requested by each client then closes"""
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", port))
+    listener.listen(100)
+
+    def serve(conn):
+        with conn:
+            n_bytes = struct.unpack("!Q", _recv_exactly(conn, 8))[0]
+            chunk = memoryview(os.urandom(256 * 1024))
+            try:
+                while n_bytes > 0:
+                    n_bytes -= conn.send(chunk[:min(n_bytes, len(chunk))])
+            except OSError:
+                # Client has gone
+                pass
+
+    def accept_loop():
+        while True:
+            conn, addr = listener.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+
+
+def _echo_server(port):
+    """Start a server that echoes everything it receives"""
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", port))
+    listener.listen(100)
+
+    def serve(conn):
+        with conn:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while True:
+                data = conn.recv(65536)
+                if len(data) == 0:
+                    return
+                conn.sendall(data)
+
+    def accept_loop():
+        while True:
+            conn, addr = listener.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+
+
+def _sink_server(port):
+    """Start a server that accepts connections and holds them open without reading"""
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", port))
+    listener.listen(1024)
+    connections = []
+
+    def accept_loop():
+        while True:
+            conn, addr = listener.accept()
+            connections.append(conn)
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return connections
+
+
+def _closing_server(port):
+    """Start a server that accepts connections and closes them straight away"""
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", port))
+    listener.listen(1024)
+
+    def accept_loop():
+        while True:
+            conn, addr = listener.accept()
+            conn.close()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+
+
+def _rss(pid):
+    """Return resident set size of a process in bytes (Linux only)"""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _tree_rss(pid):
+    """Return resident set size of a process and all its descendants in bytes (Linux only)"""
+    rss = _rss(pid)
+    with open(f"/proc/{pid}/task/{pid}/children") as children:
+        for child in children.read().split():
+            rss += _tree_rss(int(child))
+    return rss
+
+
+def _cpu_seconds(pid):
+    """Return user and system CPU time used so far by a process (Linux only)"""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _start_proxy(port, proxy_args=(), command_prefix=(), fd_limit=None):
+    """Start socks5app.py on port. command_prefix can be used to run it under a tool such as strace -c -f.
+    fd_limit sets the proxy's RLIMIT_NOFILE"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    preexec_fn = None
+    if fd_limit is not None:
+        def preexec_fn():
+            resource.setrlimit(resource.RLIMIT_NOFILE, (fd_limit, fd_limit))
+    proxy = subprocess.Popen(
+        [*command_prefix, sys.executable, os.path.join(here, "socks5app.py"), "--port", str(port),
+         "--password_file", os.path.join(here, "password_file"), *proxy_args],
+        preexec_fn=preexec_fn,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return proxy
+        except OSError:
+            time.sleep(0.05)
+    proxy.kill()
+    raise RuntimeError("Proxy did not start")
+
+
+def _stop_proxy(proxy):
+    """Stop the proxy and return its resource usage"""
+    proxy.send_signal(signal.SIGINT)
+    _, _, rusage = os.wait4(proxy.pid, 0)
+    proxy.returncode = 0
+    return rusage
+
+
+def socks_connect(proxy_port, addr, port):
+    """Open a SOCKS5 tunnel to addr:port (IPv4) without authentication"""
+    sock = socket.create_connection(("127.0.0.1", proxy_port))
+    sock.sendall(bytes([0x05, 0x01, 0x00]))
+    _recv_exactly(sock, 2)
+    sock.sendall(bytes([0x05, 0x01, 0x00, 0x01]) + socket.inet_aton(addr) + struct.pack("!H", port))
+    response = _recv_exactly(sock, 10)
+    if response[1] != 0x00:
+        raise ConnectionError(f"SOCKS connection refused: {response[1]}")
+    return sock
+
+
+def _receive_all(sock, n_bytes):
+    """Receive and discard n_bytes. Returns the number of bytes received before the connection closed"""
+    buffer = bytearray(MB)
+    received = 0
+    while received < n_bytes:
+        n = sock.recv_into(buffer)
+        if n == 0:
+            break
+        received += n
+    return received
+
+
+def _ping_pong(sock, count, size):
+    """Send count messages of size bytes one at a time, waiting for each to be echoed. Returns the round trip times"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    message = os.urandom(size)
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        sock.sendall(message)
+        _recv_exactly(sock, len(message))
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _print_latencies(latencies):
+    latencies = sorted(latencies)
+    for percentile in (50, 90, 99, 99.9):
+        print(f"p{percentile}: {latencies[int(len(latencies) * percentile / 100)] * 1e6:.1f}us")
+
+
+def bench_send_queue(args):
+    """Drain a large backlog through partial sends: bytearray slicing against SendQueue"""
+    backlog = args.backlog_mb * MB
+    chunk = os.urandom(args.chunk_kb * 1024)
+    n_chunks = backlog // len(chunk)
+    sock = _PartialSocket(args.send_kb * 1024)
+
+    buffer = bytearray()
+    for _ in range(n_chunks):
+        buffer.extend(chunk)
+    start = time.process_time()
+    while len(buffer) > 0:
+        n_bytes = sock.send(buffer)
+        buffer = buffer[n_bytes:]
+    bytearray_time = time.process_time() - start
+
+    queue = SendQueue()
+    for _ in range(n_chunks):
+        queue.append(chunk)
+    start = time.process_time()
+    while len(queue) > 0:
+        queue.send(sock)
+    queue_time = time.process_time() - start
+
+    print(f"backlog {args.backlog_mb} MiB, {args.send_kb} KiB per send")
+    print(f"bytearray: {bytearray_time:.3f}s CPU  ({bytearray_time * GB / backlog:.2f}s per GiB)")
+    print(f"SendQueue: {queue_time:.3f}s CPU  ({queue_time * GB / backlog:.2f}s per GiB)")
+
+
+def _relay(proxy_args, n_bytes, delay):
+    """Download n_bytes through a proxy, starting to read after delay seconds.
+    Returns (bytes received, seconds taken, proxy resource usage)"""
+    source_port = free_port()
+    proxy_port = free_port()
+    _source_server(source_port)
+    proxy = _start_proxy(proxy_port, proxy_args)
+    try:
+        start = time.monotonic()
+        sock = socks_connect(proxy_port, "127.0.0.1", source_port)
+        sock.sendall(struct.pack("!Q", n_bytes))
+        time.sleep(delay)
+        received = _receive_all(sock, n_bytes)
+        elapsed = time.monotonic() - start
+        sock.close()
+    finally:
+        rusage = _stop_proxy(proxy)
+    return received, elapsed, rusage
+
+
+def bench_relay(args):
+    """Relay bulk data from a local server to a client that starts reading late, so the proxy
+    holds a large write backlog. Reports throughput and proxy CPU per GiB relayed."""
+    received, elapsed, rusage = _relay(args.proxy_args, args.mb * MB, args.delay)
+    cpu = rusage.ru_utime + rusage.ru_stime
+    print(f"relayed {received / MB:.0f} MiB in {elapsed:.2f}s ({received * 8 / elapsed / 1e9:.2f} Gbit/s)")
+    print(f"proxy CPU {cpu:.2f}s ({cpu * GB / max(received, 1):.2f}s per GiB, {cpu * 100 / elapsed:.0f}% of one core)")
+    print(f"proxy max RSS {rusage.ru_maxrss / 1024:.1f} MiB")
+
+
+def _proxy_ping_pong(proxy_args, count, size, command_prefix=()):
+    """Ping pong count messages of size bytes through a proxy to an echo server.
+    Returns (round trip times, proxy resource usage)"""
+    echo_port = free_port()
+    proxy_port = free_port()
+    _echo_server(echo_port)
+    proxy = _start_proxy(proxy_port, proxy_args, command_prefix)
+    try:
+        sock = socks_connect(proxy_port, "127.0.0.1", echo_port)
+        latencies = _ping_pong(sock, count, size)
+        sock.close()
+    finally:
+        rusage = _stop_proxy(proxy)
+    return latencies, rusage
+
+
+def bench_ping_pong(args):
+    """Send small messages through the proxy to an echo server one at a time.
+    Reports per-message round trip latency and proxy CPU per message.
+    Use --strace to count proxy system calls (requires strace)."""
+    prefix = ("strace", "-c", "-f", "-o", args.strace) if args.strace else ()
+    latencies, rusage = _proxy_ping_pong(args.proxy_args, args.count, args.size, prefix)
+    cpu = rusage.ru_utime + rusage.ru_stime
+    print(f"{args.count} messages of {args.size} bytes")
+    _print_latencies(latencies)
+    print(f"proxy CPU {cpu:.2f}s ({cpu * 1e6 / args.count:.1f}us per round trip)")
+    if args.strace:
+        print(f"system call counts written to {args.strace}")
+
+
+def _download(proxy_port, source_port, stop, results):
+    """Bulk download through the proxy until stop is set. Runs in a separate process so that
+    it does not compete with the interactive session for the GIL"""
+    sock = socks_connect(proxy_port, "127.0.0.1", source_port)
+    sock.sendall(struct.pack("!Q", 1 << 62))
+    buffer = bytearray(MB)
+    total = 0
+    while not stop.is_set():
+        total += sock.recv_into(buffer)
+    sock.close()
+    results.put(total)
+
+
+def bench_mixed(args):
+    """Run bulk downloads and an interactive ping pong session through the proxy at the same time.
+    Reports bulk throughput and the round trip latency seen by the interactive session."""
+    source_port = free_port()
+    echo_port = free_port()
+    proxy_port = free_port()
+    _source_server(source_port)
+    _echo_server(echo_port)
+    proxy = _start_proxy(proxy_port, args.proxy_args)
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    try:
+        sock = socks_connect(proxy_port, "127.0.0.1", echo_port)
+        downloads = [
+            multiprocessing.Process(target=_download, args=(proxy_port, source_port, stop, results))
+            for _ in range(args.bulk)
+        ]
+        for download in downloads:
+            download.start()
+        time.sleep(0.5)
+        start = time.monotonic()
+        latencies = _ping_pong(sock, args.count, args.size)
+        elapsed = time.monotonic() - start
+        stop.set()
+        total = sum(results.get() for _ in downloads)
+        for download in downloads:
+            download.join()
+        sock.close()
+    finally:
+        _stop_proxy(proxy)
+    print(f"{args.bulk} bulk downloads: {total * 8 / elapsed / 1e9:.2f} Gbit/s")
+    print(f"{args.count} interactive round trips of {args.size} bytes")
+    _print_latencies(latencies)
+
+
+def _connect_loop(proxy_port, target_port, stop, results):
+    """Open and close tunnels through the proxy until stop is set"""
+    count = 0
+    errors = 0
+    while not stop.is_set():
+        try:
+            socks_connect(proxy_port, "127.0.0.1", target_port).close()
+            count += 1
+        except OSError:
+            errors += 1
+    results.put((count, errors))
+
+
+def _accept_rate(proxy_args, n_clients, seconds):
+    """Run n_clients client processes opening and closing tunnels through a proxy for seconds.
+    Returns (tunnels, errors, proxy CPU seconds, proxy RSS in bytes including worker processes,
+    listen queue overflows on the host)"""
+    target_port = free_port()
+    proxy_port = free_port()
+    _closing_server(target_port)
+    proxy = _start_proxy(proxy_port, proxy_args)
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    overflows = Connector.listen_overflows()
+    try:
+        clients = [
+            multiprocessing.Process(target=_connect_loop, args=(proxy_port, target_port, stop, results))
+            for _ in range(n_clients)
+        ]
+        for client in clients:
+            client.start()
+        time.sleep(seconds)
+        stop.set()
+        totals = [results.get() for _ in clients]
+        for client in clients:
+            client.join()
+        rss = _tree_rss(proxy.pid)
+        if overflows is not None:
+            overflows = Connector.listen_overflows() - overflows
+    finally:
+        rusage = _stop_proxy(proxy)
+    count = sum(total[0] for total in totals)
+    errors = sum(total[1] for total in totals)
+    return count, errors, rusage.ru_utime + rusage.ru_stime, rss, overflows
+
+
+def bench_accept(args):
+    """Open and close tunnels through the proxy as fast as possible from several client processes.
+    Reports tunnels per second. Compare --proxy_args --workers N on a machine with several cores."""
+    count, errors, cpu, rss, overflows = _accept_rate(args.proxy_args, args.clients, args.seconds)
+    print(f"{args.clients} clients: {count / args.seconds:.0f} tunnels/s, {errors} errors, "
+          f"{overflows} listen queue overflows")
+    print(f"proxy CPU {cpu:.2f}s ({cpu * 1e6 / max(count, 1):.1f}us per tunnel)")
+
+
+def _storm(proxy_port, n_connections, results):
+    """Open n_connections to the proxy at once, then complete a SOCKS greeting on each"""
+    start = time.monotonic()
+    socks = []
+    errors = 0
+    for _ in range(n_connections):
+        try:
+            socks.append(socket.create_connection(("127.0.0.1", proxy_port), timeout=10))
+        except OSError:
+            errors += 1
+    for sock in socks:
+        try:
+            sock.sendall(bytes([0x05, 0x01, 0x00]))
+            _recv_exactly(sock, 2)
+        except OSError:
+            errors += 1
+        sock.close()
+    results.put((time.monotonic() - start, errors))
+
+
+def bench_storm(args):
+    """Connection storm: client processes each open many connections to the proxy at once.
+    Reports the time to greet every connection, failed connections and listen queue overflows"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    proxy_port = free_port()
+    proxy = _start_proxy(proxy_port, args.proxy_args)
+    results = multiprocessing.Queue()
+    overflows = Connector.listen_overflows()
+    try:
+        clients = [multiprocessing.Process(target=_storm, args=(proxy_port, args.connections, results))
+                   for _ in range(args.clients)]
+        for client in clients:
+            client.start()
+        totals = [results.get() for _ in clients]
+        for client in clients:
+            client.join()
+        if overflows is not None:
+            overflows = Connector.listen_overflows() - overflows
+    finally:
+        _stop_proxy(proxy)
+    print(f"{args.clients} x {args.connections} connections: slowest client {max(t[0] for t in totals):.2f}s, "
+          f"{sum(t[1] for t in totals)} errors, {overflows} listen queue overflows")
+
+
+def bench_scaling(args):
+    """Compare a single event loop with N worker processes and with N event loop threads in one process.
+    Threads only run in parallel on free threaded Python. With the GIL the proxy falls back to one loop"""
+    configurations = [
+        ("1 loop", []),
+        (f"{args.n} processes", ["--workers", str(args.n)]),
+        (f"{args.n} threads", ["--threads", str(args.n)]),
+    ]
+    for name, proxy_args in configurations:
+        count, errors, cpu, rss, overflows = _accept_rate(proxy_args + args.proxy_args, args.clients, args.seconds)
+        print(f"{name:>12}: {count / args.seconds:7.0f} tunnels/s, {errors} errors, "
+              f"proxy CPU {cpu * 1e6 / max(count, 1):.1f}us per tunnel, RSS {rss / MB:.1f} MiB")
+
+
+def bench_backends(args):
+    """Run the relay and ping pong workloads on each proxy backend: the select loop, edge triggered epoll,
+    asyncio and, if installed, uvloop"""
+    backends = list(Connector.BACKENDS) + ["asyncio"]
+    if uvloop is not None:
+        backends.append("uvloop")
+    for backend in backends:
+        proxy_args = ["--backend", backend] + args.proxy_args
+        received, elapsed, rusage = _relay(proxy_args, args.mb * MB, 0)
+        relay_cpu = rusage.ru_utime + rusage.ru_stime
+        latencies, rusage = _proxy_ping_pong(proxy_args, args.count, 64)
+        ping_pong_cpu = rusage.ru_utime + rusage.ru_stime
+        latencies.sort()
+        print(f"{backend:>9}: relay {received * 8 / elapsed / 1e9:5.2f} Gbit/s "
+              f"{relay_cpu * GB / max(received, 1):.2f}s CPU per GiB, "
+              f"ping pong p50 {latencies[len(latencies) // 2] * 1e6:.1f}us "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f}us "
+              f"{ping_pong_cpu * 1e6 / args.count:.1f}us CPU per round trip")
+
+
+def bench_loop(args):
+    """Measure event loop dispatch rate for each Connector backend, in process.
+    Tokens are passed around a ring of socket pairs. Each callback reads what has arrived and
+    forwards it to the next pair, so every event costs one recv and one send.
+    Loop overhead is the time not spent in callbacks, per event. With --loop_stats each backend is also run
+    recording LoopStats, to show the cost of the instrumentation."""
+    runs = [(backend, loop_stats) for backend in Connector.BACKENDS for loop_stats in (False, args.loop_stats)
+            if not loop_stats or args.loop_stats]
+    for backend, loop_stats in runs:
+        connector = Connector(backend=backend, loop_stats=LoopStats() if loop_stats else None)
+        pairs = [socket.socketpair() for _ in range(args.connections)]
+        for pair in pairs:
+            for sock in pair:
+                sock.setblocking(False)
+        counters = {"events": 0, "callback_time": 0.0}
+
+        def forward_to(next_sock):
+            def on_readable(sock, mask):
+                start = time.perf_counter()
+                try:
+                    data = sock.recv(4096)
+                except BlockingIOError:
+                    return
+                next_sock.send(data)
+                counters["events"] += 1
+                counters["callback_time"] += time.perf_counter() - start
+            return on_readable
+
+        for i, (reader, writer) in enumerate(pairs):
+            connector.selector.register(reader, selectors.EVENT_READ, forward_to(pairs[(i + 1) % len(pairs)][1]))
+        for i in range(min(args.tokens, len(pairs))):
+            pairs[i * len(pairs) // args.tokens][1].send(b"x")
+
+        iterations = 0
+        start = time.perf_counter()
+        end = start + args.seconds
+        while time.perf_counter() < end:
+            connector.run_once()
+            iterations += 1
+        elapsed = time.perf_counter() - start
+        connector.shutdown()
+        for pair in pairs:
+            for sock in pair:
+                sock.close()
+        events = counters["events"]
+        overhead = elapsed - counters["callback_time"]
+        print(f"{backend}{' with loop_stats' if loop_stats else ''}: {events / elapsed:,.0f} events/s, "
+              f"{events / iterations:.1f} events per iteration, "
+              f"loop overhead {overhead * 1e6 / max(events, 1):.2f}us per event")
+
+
+def bench_resolve(args):
+    """Bursts of host name lookups through Connector.getaddrinfo, in process.
+    Each burst looks up --lookups names drawn from --names distinct names, which all resolve as localhost,
+    with --latency added to each lookup to stand in for a DNS server.
+    Reports lookup throughput and latency, the most threads running at once and the growth in peak memory"""
+    cache = DnsCache(max_entries=args.cache_size) if args.cache_size else None
+    pool = ResolverPool(n_threads=args.threads, max_queue=args.queue, cache=cache)
+    lookup = socket.getaddrinfo
+
+    def slow_lookup(hostname, *args_, **kwargs):
+        time.sleep(args.latency / 1000)
+        return lookup("localhost", *args_, **kwargs)
+    socket.getaddrinfo = slow_lookup
+    connector = Connector(resolver=pool)
+    results = {"done": 0, "failed": 0, "latency": 0.0, "max_threads": threading.active_count()}
+
+    def resolved(requested, addresses):
+        results["done"] += 1
+        results["latency"] += time.perf_counter() - requested
+        if not addresses:
+            results["failed"] += 1
+        results["max_threads"] = max(results["max_threads"], threading.active_count())
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for burst in range(args.bursts):
+        results.update(done=0, failed=0, latency=0.0)
+        start = time.perf_counter()
+        for i in range(args.lookups):
+            connector.getaddrinfo(f"host{i % args.names}.test", functools.partial(resolved, time.perf_counter()))
+        while results["done"] < args.lookups:
+            connector.run_once(timeout=0.1)
+        elapsed = time.perf_counter() - start
+        print(f"burst {burst + 1}: {args.lookups} lookups in {elapsed:.2f}s, {args.lookups / elapsed:,.0f} lookups/s, "
+              f"mean latency {results['latency'] * 1e3 / args.lookups:.1f}ms, {results['failed']} failed")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    stats = pool.stats()
+    print(f"at most {results['max_threads']} threads, peak RSS +{rss / 1024:.1f} MiB")
+    print(f"resolver: {stats['completed']} lookups, {stats['coalesced']} coalesced, {stats['rejected']} rejected, "
+          f"queue depth up to {stats['max_queue_depth']}, mean lookup {stats['mean_lookup_ms']:.1f}ms")
+    if cache is not None:
+        print(f"cache: {stats['cache']}")
+    connector.shutdown()
+
+
+def bench_dns(args):
+    """Bursts of host name lookups through DnsClient on the loop, against a stand-in DNS server in a thread.
+    Each burst looks up the IPv6 and IPv4 addresses of --lookups distinct names. --drop ignores a fraction
+    of queries so they are resent.
+    Reports lookup throughput and latency, and the threads running in the process"""
+    dns_port = free_port()
+    server = start_dns_server(dns_port, drop=args.drop)
+    connector = Connector()
+    cache = DnsCache(max_entries=args.lookups) if args.cache else None
+    # Room to queue a whole burst, so the run measures lookups rather than rejections
+    connector.dns_client = DnsClient(connector, nameservers=[("127.0.0.1", dns_port)], timeout=args.timeout,
+                                     attempts=3, cache=cache, max_queue=args.lookups)
+    results = {"done": 0, "failed": 0, "latency": 0.0}
+
+    def resolved(requested, addresses):
+        results["done"] += 1
+        results["latency"] += time.perf_counter() - requested
+        if not addresses:
+            results["failed"] += 1
+
+    for burst in range(args.bursts):
+        results.update(done=0, failed=0, latency=0.0)
+        start = time.perf_counter()
+        for i in range(args.lookups):
+            connector.getaddrinfo(f"host{i}.test", functools.partial(resolved, time.perf_counter()))
+        while results["done"] < args.lookups:
+            connector.run_once()
+        elapsed = time.perf_counter() - start
+        print(f"burst {burst + 1}: {args.lookups} lookups in {elapsed:.2f}s, {args.lookups / elapsed:,.0f} lookups/s, "
+              f"mean latency {results['latency'] * 1e3 / args.lookups:.1f}ms, {results['failed']} failed")
+    stats = connector.dns_client.stats()
+    print(f"{threading.active_count()} threads in this process (1 is the stand-in server), "
+          f"server saw {server['queries']} queries, dropped {server['dropped']}")
+    print(f"client: {stats}")
+    connector.shutdown()
+
+
+class _TimedProtocol(Protocol):
+    """Records when its connection is made, then closes it"""
+
+    __slots__ = ("_results", "_requested", "_timer")
+
+    def __init__(self, results, requested):
+        super().__init__()
+        self._results = results
+        self._requested = requested
+        self._timer = None
+
+    def on_connect(self):
+        self._results["latencies"].append(time.perf_counter() - self._requested)
+        if self._timer is not None:
+            self._timer.cancel()
+        self.close()
+
+    def connect_failed(self):
+        self._results["failed"] += 1
+        self._results["latencies"].append(time.perf_counter() - self._requested)
+
+
+def bench_eyeballs(args):
+    """Connections to a host whose first address does not answer, in process.
+    The first address, 127.0.0.2, has a full listen queue so the kernel drops SYNs sent to it, and the
+    second, 127.0.0.1, accepts. Compares connecting to the first address only, giving up after --timeout
+    as the proxy's connect timeout does, with racing both addresses (Connector.create_client with a list).
+    Reports connect latency percentiles and failures"""
+    port = free_port()
+    dead = socket.socket()
+    dead.bind(("127.0.0.2", port))
+    dead.listen(0)
+    fillers = []
+    for _ in range(2):
+        # One connection fills the queue and the next waits for a SYN ACK that never comes
+        filler = socket.socket()
+        filler.setblocking(False)
+        filler.connect_ex(("127.0.0.2", port))
+        fillers.append(filler)
+    live = socket.socket()
+    live.bind(("127.0.0.1", port))
+    live.listen(socket.SOMAXCONN)
+    addresses = ["127.0.0.2", "127.0.0.1"]
+    for name, race in (("first address only", False), ("happy eyeballs", True)):
+        connector = Connector(connect_attempt_delay=args.delay / 1000)
+        results = {"latencies": [], "failed": 0}
+        start = time.perf_counter()
+        for _ in range(args.connections):
+            protocol = _TimedProtocol(results, time.perf_counter())
+            protocol._timer = connector.call_later(args.timeout, protocol.close)
+            connector.create_client(addresses if race else addresses[0], port, protocol, protocol.connect_failed)
+        while len(results["latencies"]) < args.connections:
+            connector.run_once(timeout=0.1)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {args.connections} connections in {elapsed:.2f}s, {results['failed']} failed")
+        _print_latencies(results["latencies"])
+        # Connections made are left in the live listen queue. Drain them so the next run does not fill it
+        live.setblocking(False)
+        try:
+            while True:
+                live.accept()[0].close()
+        except BlockingIOError:
+            pass
+        connector.shutdown()
+    for sock in fillers + [dead, live]:
+        sock.close()
+
+
+def bench_overload(args):
+    """Open more tunnels than the proxy's file descriptor limit allows and hold them.
+    Reports how many tunnels were made, how many failed and how quickly, and the proxy CPU used while
+    overloaded, which shows whether the loop spins on a listening socket it cannot accept from"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    sink_port = free_port()
+    proxy_port = free_port()
+    _sink_server(sink_port)
+    proxy = _start_proxy(proxy_port, args.proxy_args, fd_limit=args.fd_limit)
+    tunnels = []
+    failures = []
+    try:
+        for _ in range(args.tunnels):
+            start = time.monotonic()
+            try:
+                sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=args.timeout)
+                tunnels.append(sock)
+                sock.sendall(bytes([0x05, 0x01, 0x00]))
+                if _recv_exactly(sock, 2)[1] != 0x00:
+                    raise ConnectionError("No acceptable methods")
+                sock.sendall(bytes([0x05, 0x01, 0x00, 0x01]) + socket.inet_aton("127.0.0.1")
+                             + struct.pack("!H", sink_port))
+                if _recv_exactly(sock, 10)[1] != 0x00:
+                    raise ConnectionError("Connection refused")
+            except OSError:
+                failures.append(time.monotonic() - start)
+                tunnels.pop().close()
+        cpu = _cpu_seconds(proxy.pid)
+        time.sleep(args.hold)
+        cpu = _cpu_seconds(proxy.pid) - cpu
+        running = proxy.poll() is None
+    finally:
+        for sock in tunnels:
+            sock.close()
+        if proxy.poll() is None:
+            _stop_proxy(proxy)
+    print(f"fd limit {args.fd_limit}: {len(tunnels)} tunnels made, {len(failures)} failed"
+          + (f" (median {sorted(failures)[len(failures) // 2] * 1e3:.0f}ms to fail)" if failures else ""))
+    print(f"proxy {'running' if running else 'exited'}, CPU {cpu * 100 / args.hold:.0f}% of one core "
+          f"while holding the tunnels")
+
+
+def bench_memory(args):
+    """Open many idle tunnels through the proxy and report the proxy memory used per tunnel"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    sink_port = free_port()
+    proxy_port = free_port()
+    _sink_server(sink_port)
+    proxy = _start_proxy(proxy_port, args.proxy_args)
+    tunnels = []
+    try:
+        # Warm up so one off allocations are not counted
+        tunnels.append(socks_connect(proxy_port, "127.0.0.1", sink_port))
+        time.sleep(0.2)
+        start_rss = _rss(proxy.pid)
+        for _ in range(args.tunnels):
+            tunnels.append(socks_connect(proxy_port, "127.0.0.1", sink_port))
+        time.sleep(0.2)
+        end_rss = _rss(proxy.pid)
+    finally:
+        for sock in tunnels:
+            sock.close()
+        _stop_proxy(proxy)
+    print(f"{args.tunnels} idle tunnels: proxy RSS grew {(end_rss - start_rss) / MB:.1f} MiB "
+          f"({(end_rss - start_rss) / args.tunnels:.0f} bytes per tunnel)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Socks5 Proxy benchmarks.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    send_queue = subparsers.add_parser("sendqueue", help="write buffer drain cost with a large backlog")
+    send_queue.add_argument("--backlog_mb", type=int, default=64)
+    send_queue.add_argument("--chunk_kb", type=int, default=8)
+    send_queue.add_argument("--send_kb", type=int, default=64)
+    send_queue.set_defaults(func=bench_send_queue)
+
+    relay = subparsers.add_parser("relay", help="bulk relay through the proxy")
+    relay.add_argument("--mb", type=int, default=1024)
+    relay.add_argument("--delay", type=float, default=1.0, help="seconds before the client starts reading")
+    relay.add_argument("--proxy_args", nargs=argparse.REMAINDER, default=[])
+    relay.set_defaults(func=bench_relay)
+
+    ping_pong = subparsers.add_parser("pingpong", help="small message round trip latency")
+    ping_pong.add_argument("--count", type=int, default=20000)
+    ping_pong.add_argument("--size", type=int, default=64)
+    ping_pong.add_argument("--strace", help="run the proxy under strace -c and write the summary to this file")
+    ping_pong.add_argument("--proxy_args", nargs=argparse.REMAINDER, default=[])
+    ping_pong.set_defaults(func=bench_ping_pong)
+
+    mixed = subparsers.add_parser("mixed", help="bulk throughput and interactive latency together")
+    mixed.add_argument("--bulk", type=int, default=2, help="number of bulk downloads")
+    mixed.add_argument("--count", type=int, default=5000)
+    mixed.add_argument("--size", type=int, default=64)
+    mixed.add_argument("--proxy_args", nargs=argparse.REMAINDER, default=[])
+    mixed.set_defaults(func=bench_mixed)
+
+    accept = subparsers.add_parser("accept", help="tunnel setup rate")
+    accept.add_argument("--clients", type=int, default=4, help="number of client processes")
+    accept.add_argument("--seconds", type=float, default=5.0)
+    accept.add_argument("--proxy_args", nargs=argparse.REMAINDER, default=[])
+    accept.set_defaults(func=bench_accept)
+
+    storm = subparsers.add_parser("storm", help="many connections opened at once")
+    storm.add_argument("--clients", type=int, default=4, help="number of client processes")
+    storm.add_argument("--connections", type=int, default=2000, help="connections opened by each client")
+    storm.add_argument("--proxy_args", nargs=argparse.REMAINDER, default=[])
+    storm.set_defaults(func=bench_storm)
+
+    scaling = subparsers.add_parser("scaling", help="tunnel setup rate for worker processes and loop threads")
+    scaling.add_argument("-n", type=int, default=4, help="number of processes or threads")
+    scaling.add_argument("--clients", type=int, default=4, help="number of client processes")
+    scaling.add_argument("--seconds", type=float, default=5.0)
+    scaling.add_argument("--proxy_args", nargs=argparse.REMAINDER, default=[])
+    scaling.set_defaults(func=bench_scaling)
+
+    backends = subparsers.add_parser("backends", help="relay and ping pong on each proxy backend")
+    backends.add_argument("--mb", type=int, default=1024)
+    backends.add_argument("--count", type=int, default=20000)
+    backends.add_argument("--proxy_args", nargs=argparse.REMAINDER, default=[])
+    backends.set_defaults(func=bench_backends)
+
+    loop = subparsers.add_parser("loop", help="event loop dispatch rate for each backend")
+    loop.add_argument("--connections", type=int, default=1000)
+    loop.add_argument("--tokens", type=int, default=100, help="number of connections with data in flight")
+    loop.add_argument("--seconds", type=float, default=3.0)
+    loop.add_argument("--loop_stats", action="store_true", help="also run each backend recording LoopStats")
+    loop.set_defaults(func=bench_loop)
+
+    resolve = subparsers.add_parser("resolve", help="bursts of host name lookups")
+    resolve.add_argument("--lookups", type=int, default=5000, help="lookups in each burst")
+    resolve.add_argument("--names", type=int, default=1000, help="number of distinct names looked up")
+    resolve.add_argument("--bursts", type=int, default=2)
+    resolve.add_argument("--cache_size", type=int, default=10000, help="DnsCache entries. 0 for no cache")
+    resolve.add_argument("--latency", type=float, default=20.0, help="milliseconds added to each lookup")
+    resolve.add_argument("--threads", type=int, default=32, help="resolver threads")
+    resolve.add_argument("--queue", type=int, default=4096, help="resolver queue length")
+    resolve.set_defaults(func=bench_resolve)
+
+    dns = subparsers.add_parser("dns", help="host name lookups with the event loop DNS client")
+    dns.add_argument("--lookups", type=int, default=5000, help="distinct names looked up in each burst")
+    dns.add_argument("--bursts", type=int, default=2)
+    dns.add_argument("--drop", type=float, default=0.0, help="fraction of queries the server ignores")
+    dns.add_argument("--timeout", type=float, default=0.5, help="seconds before a query is resent")
+    dns.add_argument("--cache", action="store_true", help="cache answers in a DnsCache")
+    dns.set_defaults(func=bench_dns)
+
+    eyeballs = subparsers.add_parser("eyeballs", help="connections to a host whose first address does not answer")
+    eyeballs.add_argument("--connections", type=int, default=500)
+    eyeballs.add_argument("--delay", type=float, default=250.0, help="connection attempt delay in milliseconds")
+    eyeballs.add_argument("--timeout", type=float, default=5.0, help="seconds before a connection is abandoned")
+    eyeballs.set_defaults(func=bench_eyeballs)
+
+    overload = subparsers.add_parser("overload", help="more tunnels than the proxy file descriptor limit")
+    overload.add_argument("--fd_limit", type=int, default=256, help="proxy RLIMIT_NOFILE")
+    overload.add_argument("--tunnels", type=int, default=300)
+    overload.add_argument("--timeout", type=float, default=1.0, help="seconds before a client gives up")
+    overload.add_argument("--hold", type=float, default=2.0, help="seconds to hold the tunnels open")
+    overload.add_argument("--proxy_args", nargs=argparse.REMAINDER, default=[])
+    overload.set_defaults(func=bench_overload)
+
+    memory = subparsers.add_parser("memory", help="proxy memory per idle tunnel")
+    memory.add_argument("--tunnels", type=int, default=4000)
+    memory.add_argument("--proxy_args", nargs=argparse.REMAINDER, default=[])
+    memory.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+class BufferPool:
+    """Pool of reusable receive buffers.
+
+    Buffers are handed out in power of two size classes between min_size and max_size.
+    Released buffers are kept for reuse until the pool holds max_pooled_bytes, after which
+    they are left for the garbage collector.
+    The pool is not thread safe. Each Connector has its own pool used from its event loop.
+    """
+
+    def __init__(self, min_size=4096, max_size=262144, max_pooled_bytes=4194304):
+        self._sizes = []
+        size = min_size
+        while size < max_size:
+            self._sizes.append(size)
+            size *= 2
+        self._sizes.append(max_size)
+        self._free = {size: [] for size in self._sizes}
+        self._max_pooled_bytes = max_pooled_bytes
+        self._pooled_bytes = 0
+        self.allocations = 0    # Number of buffers created because the pool was empty
+
+    def size_class(self, size):
+        """Return the size of buffer that would be handed out for a request of size bytes"""
+        for size_class in self._sizes:
+            if size <= size_class:
+                return size_class
+        return self._sizes[-1]
+
+    def acquire(self, size):
+        """Return a bytearray of at least size bytes, or of max_size if size is larger"""
+        size_class = self.size_class(size)
+        free = self._free[size_class]
+        if free:
+            self._pooled_bytes -= size_class
+            return free.pop()
+        self.allocations += 1
+        return bytearray(size_class)
+
+    def release(self, buf):
+        """Return a buffer obtained from acquire to the pool"""
+        free = self._free.get(len(buf))
+        if free is not None and self._pooled_bytes + len(buf) <= self._max_pooled_bytes:
+            self._pooled_bytes += len(buf)
+            free.append(buf)
+
+    def pooled_bytes(self):
+        return self._pooled_bytes
@@ -1,9 +1,19 @@
 import atexit
+import collections
+import errno
 import logging
+import select
 import selectors
 import socket
 import functools
-import threading
+from buffer_pool import BufferPool
+from dns_cache import DnsCache
+from epoll_selector import EdgeTriggeredSelector
+from happy_eyeballs import ConnectionRace
+from protocol import Protocol
+from resolver import ResolverPool
+from timer_wheel import TimerWheel
+from waker import Waker
 
 logger = logging.getLogger(__name__)
 
@@ -13,20 +23,91 @@ class Connector:
 
     EINPROGRESS = 115
 
-    def __init__(self):
-        self.selector = selectors.DefaultSelector()
+    # accept errors caused by running out of descriptors or memory. Accepting is paused for a while
+    RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+    ACCEPT_RETRY_DELAY = 0.1
+
+    BACKENDS = ("selectors", "epoll")
+
+    def __init__(self, max_read_size=262144, coalesce_writes=True, read_budget=262144, backend="selectors",
+                 accept_batch=64, loop_stats=None, resolver=None, connect_attempt_delay=0.25):
+        """Arguments:
+        max_read_size -- largest single read from a socket. Connections grow their reads towards this during bulk transfers
+        coalesce_writes -- buffer writes made while handling events and flush them at the end of the loop iteration
+        read_budget -- most bytes read from one connection in a loop iteration before moving on to the next
+        backend -- "selectors" for selectors.DefaultSelector or "epoll" for an edge triggered epoll selector (Linux only)
+        accept_batch -- most connections accepted from a listening socket in a loop iteration
+        loop_stats -- a LoopStats to record event loop timings in. None to record nothing. The attribute
+                      can also be set or cleared while the loop runs
+        resolver -- a ResolverPool for getaddrinfo, which may be shared with other connectors.
+                    None for a pool of this connector's own
+        connect_attempt_delay -- seconds create_client waits for a connection to one address of a host before
+                                 also trying the next
+        """
+        if backend == "selectors":
+            self.selector = selectors.DefaultSelector()
+            self.edge_triggered = False
+        elif backend == "epoll" and hasattr(select, "epoll"):
+            self.selector = EdgeTriggeredSelector()
+            self.edge_triggered = True
+        else:
+            raise ValueError(f"Unsupported backend: {backend}")
+        self.max_read_size = max_read_size
+        self.buffer_pool = BufferPool(max_size=max_read_size)
+        self.coalesce_writes = coalesce_writes
+        self.read_budget = read_budget
+        self.accept_batch = accept_batch
+        self.accepted = 0               # Number of connections accepted
+        self.accept_batches_full = 0    # Number of times accept stopped at accept_batch with connections still waiting
+        self.accept_errors = 0          # Number of accepts that failed for lack of descriptors or memory
+        self._listeners = set()         # Listening sockets created by create_server
+        self._paused_listeners = set()  # Listening sockets not being accepted from
+        self._rotation = 0              # Offset of the first event handled, advanced each loop iteration
+        self.coalescing = False         # True while handling events if writes are being coalesced
+        self._pending_flushes = []      # Protocols with writes to flush at the end of this loop iteration
+        self._pending_reads = []        # Callbacks to carry on reading next loop iteration (edge triggered only)
+        self.connections = 0            # Number of sockets owned by protocols, connection attempts and DNS queries
+        self.pipe_fds = 0               # Number of descriptors of splice pipes owned by protocols of this connector
+        self.timers = TimerWheel()
+        self._ready = collections.deque()      # (callback, args) queued by call_soon_threadsafe
+        self._running = False
+        self.loop_stats = loop_stats
+        self.resolver = resolver if resolver is not None else ResolverPool()
+        self.dns_client = None          # DnsClient used by getaddrinfo in place of the resolver, if set
+        self.connect_attempt_delay = connect_attempt_delay
+
+        # Wakes the loop when another thread queues a callback
+        self._waker = Waker()
+        self.selector.register(self._waker, selectors.EVENT_READ, self._wakeup)
         atexit.register(self.shutdown)
 
     def create_client(self, addr, port, protocol, on_failure=None):
         """Create a network client
 
         Arguments:
-        addr -- the remote server address
+        addr -- the remote server address, or a list of the addresses of one host as returned by getaddrinfo.
+                Connections to several addresses are raced, Happy Eyeballs style, and the first to connect is used
         port -- the remote server port
         protocol -- the Protocol instance used to manage the connection
         on_failure -- function to call if connection setup fails
         """
-        sock = socket.socket()
+        if isinstance(addr, list):
+            if len(addr) > 1:
+                ConnectionRace(self, addr, port, protocol, on_failure, self.connect_attempt_delay).start()
+                return
+            if not addr:
+                if on_failure is not None:
+                    on_failure()
+                return
+            addr = addr[0]
+        try:
+            sock = socket.socket(socket.AF_INET6 if ":" in addr else socket.AF_INET, socket.SOCK_STREAM)
+        except OSError as e:
+            # Out of descriptors
+            logger.warning(f"Unable to create socket: {e}")
+            if on_failure is not None:
+                on_failure()
+            return
         sock.setblocking(False)
         try:
             sock.connect((addr, port))
@@ -45,65 +126,383 @@ class Connector:
             protocol._connection_created(self, self.selector, sock, on_failure)
 
 
-    def create_server(self, interface, port, protocol_factory):
-        """Create a server for processing network events.
+    def create_server(self, interface, port, protocol_factory, reuse_port=False, loops=None, backlog=socket.SOMAXCONN,
+                      admission=None, sock=None):
+        """Create a server for processing network events. Returns the listening socket.
 
         Arguments:
         interface -- the listener interface (e.g. 0.0.0.0)
         port -- the listening port
         protocol_factory -- an instance of a ProtocolFactory class used to manage new server connections
+        reuse_port -- set SO_REUSEPORT so that several processes can listen on the same port, with the kernel
+                      spreading new connections between them
+        loops -- Connectors, which may include this one, to share new connections between. Each connection
+                 goes to the one with the fewest connections. None to handle every connection here
+        backlog -- length of the listen queue. The kernel limits this to net.core.somaxconn
+        admission -- an AdmissionControl that limits connections to the file descriptor budget. None for no limit
+        sock -- a socket that is already listening, such as one passed on by the process being replaced.
+                interface, port and reuse_port are not used
         """
-        sock = socket.socket()
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((interface, port))
-        sock.listen(100)
+        if sock is None:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((interface, port))
+        sock.listen(backlog)
         sock.setblocking(False)
+        self._listeners.add(sock)
 
         # Socket is registered to handle new connections using the accept method
-        self.selector.register(sock, selectors.EVENT_READ, functools.partial(self.accept, protocol_factory=protocol_factory))
+        self.selector.register(sock, selectors.EVENT_READ, functools.partial(
+            self.accept, protocol_factory=protocol_factory, loops=loops, admission=admission))
+        return sock
+
+    def stop_accepting(self):
+        """Stop accepting and close the listening sockets. Established connections carry on.
+        Connections waiting in a listen queue are kept if another process holds the socket"""
+        for sock in self._listeners:
+            if sock not in self._paused_listeners:
+                try:
+                    self.selector.unregister(sock)
+                except (ValueError, KeyError) as e:
+                    logger.debug(f"Selector registration error: {e}")
+            sock.close()
+        self._listeners.clear()
+        self._paused_listeners.clear()
+
+    def accept(self, sock, mask, protocol_factory, loops=None, admission=None):
+        """Accept new server connections, up to accept_batch of them.
+        If connections are left in the listen queue a level triggered selector reports the listening socket
+        again. An edge triggered selector does not, so accept is scheduled to run again next iteration.
+        Accepting pauses, rather than spinning on a listening socket that stays readable, when admission
+        control says a connection would not fit or when accept fails for lack of descriptors"""
+        if sock not in self._listeners or sock in self._paused_listeners:
+            return
+        for _ in range(self.accept_batch):
+            shed = False
+            if admission is not None and not admission.admit(self._load(loops)):
+                if not admission.shed:
+                    self._pause_accepting(sock, protocol_factory, loops, admission)
+                    return
+                shed = True
+
+            # Create new non-blocking connection
+            try:
+                conn, addr = sock.accept()
+            except BlockingIOError:
+                return
+            except ConnectionAbortedError:
+                # Client reset the connection while it was waiting in the listen queue
+                continue
+            except OSError as e:
+                if e.errno not in Connector.RESOURCE_ERRORS:
+                    raise
+                logger.warning(f"Unable to accept connection: {e}")
+                self.accept_errors += 1
+                self._pause_accepting(sock, protocol_factory, loops, admission)
+                return
+            conn.setblocking(False)
+            self.accepted += 1
+            if shed:
+                self._reject(conn, protocol_factory)
+                admission.rejected += 1
+                continue
+
+            connector = self if loops is None else min(loops, key=Connector.load)
+            if connector is self:
+                self._create_server_protocol(conn, protocol_factory)
+            else:
+                connector.adopt(conn, protocol_factory)
+        self.accept_batches_full += 1
+        if self.edge_triggered:
+            self.schedule_read(functools.partial(self.accept, sock, mask, protocol_factory, loops, admission))
 
-    def accept(self, sock, mask, protocol_factory):
-        """Accept a new server connection."""
-        # Create new non-blocking connection
-        conn, addr = sock.accept()
-        conn.setblocking(False)
+    def _load(self, loops):
+        return self.load() if loops is None else sum(loop.load() for loop in loops)
 
+    @staticmethod
+    def _reject(conn, protocol_factory):
+        """Close a connection turned away by admission control, sending the factory's overload response"""
+        try:
+            # Read whatever the client has sent so that closing does not reset the connection
+            conn.recv(4096)
+        except OSError:
+            pass
+        response = protocol_factory.overload_response()
+        try:
+            if response:
+                conn.send(response)
+        except OSError:
+            pass
+        conn.close()
+
+    def _pause_accepting(self, sock, protocol_factory, loops, admission):
+        """Stop accepting from sock, and check every ACCEPT_RETRY_DELAY seconds whether it can start again"""
+        logger.info(f"Pausing accepting connections: {self._load(loops)} descriptors used by connections")
+        self._paused_listeners.add(sock)
+        if admission is not None:
+            admission.paused += 1
+        try:
+            self.selector.unregister(sock)
+        except (ValueError, KeyError) as e:
+            logger.debug(f"Selector registration error: {e}")
+        self.call_later(Connector.ACCEPT_RETRY_DELAY, self._resume_accepting, sock, protocol_factory, loops, admission)
+
+    def _resume_accepting(self, sock, protocol_factory, loops, admission):
+        if sock not in self._listeners:
+            # Closed by stop_accepting
+            return
+        if admission is not None and not admission.can_resume(self._load(loops)):
+            self.call_later(Connector.ACCEPT_RETRY_DELAY, self._resume_accepting, sock, protocol_factory, loops, admission)
+            return
+        logger.info("Resuming accepting connections")
+        self._paused_listeners.discard(sock)
+        self.selector.register(sock, selectors.EVENT_READ, functools.partial(
+            self.accept, protocol_factory=protocol_factory, loops=loops, admission=admission))
+
+    @staticmethod
+    def listen_overflows():
+        """Number of connections dropped because a listen queue was full, counted by the kernel for the whole
+        host since boot (TcpExt ListenOverflows). None where this is not available (Linux only)"""
+        try:
+            with open("/proc/net/netstat") as netstat:
+                lines = netstat.read().splitlines()
+        except OSError:
+            return None
+        for names, values in zip(lines[::2], lines[1::2]):
+            if names.startswith("TcpExt:"):
+                counters = dict(zip(names.split()[1:], values.split()[1:]))
+                if "ListenOverflows" in counters:
+                    return int(counters["ListenOverflows"])
+        return None
+
+    def _create_server_protocol(self, conn, protocol_factory):
         # Create new protocol object to handle connection
         protocol = protocol_factory.create()
 
         # Configure protocol with connector, selector and socket
         protocol._connection_created(self, self.selector, conn)
 
-    def gethostbyname(self, hostname, callback):
-        """Non-blocking version of gethostbyname() - need to use thread - yuk
+    def stats(self):
+        """Return a dictionary of connector statistics, including event loop timings if loop_stats is set.
+        May be called from any thread"""
+        stats = {
+            "connections": self.connections,
+            "pipe_fds": self.pipe_fds,
+            "accepted": self.accepted,
+            "accept_batches_full": self.accept_batches_full,
+            "accept_errors": self.accept_errors,
+            "timers": len(self.timers),
+            "buffer_allocations": self.buffer_pool.allocations,
+            "resolver": self.resolver.stats(),
+        }
+        if self.dns_client is not None:
+            stats["dns_client"] = self.dns_client.stats()
+        loop_stats = self.loop_stats
+        if loop_stats is not None:
+            stats["loop"] = loop_stats.snapshot()
+        return stats
+
+    def load(self):
+        """Number of file descriptors owned by this connector's protocols, sockets and splice pipes, plus
+        callbacks queued for it such as connections handed over but not yet started"""
+        return self.connections + self.pipe_fds + len(self._ready)
+
+    def adopt(self, sock, protocol_factory):
+        """Hand an accepted connection to this connector. May be called from any thread.
+        The protocol is created on this connector's loop thread"""
+        self.call_soon_threadsafe(self._create_server_protocol, sock, protocol_factory)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Call callback(*args) on the loop thread as soon as possible. May be called from any thread.
+        Use this to pass results from worker threads back to protocols"""
+        self._ready.append((callback, args))
+        self._waker.wake()
+
+    def _wakeup(self, waker, mask):
+        """Called on the loop thread when other threads have queued callbacks.
+        Callbacks queued while these run wake the loop again and wait for the next iteration"""
+        self._waker.drain()
+        ready = self._ready
+        for _ in range(len(ready)):
+            callback, args = ready.popleft()
+            callback(*args)
+
+    def getaddrinfo(self, hostname, callback):
+        """Non-blocking lookup of the IPv6 and IPv4 addresses of a host, for create_client. The lookup is sent
+        by dns_client if it is set, or runs getaddrinfo() in the resolver's thread pool. If the name is cached,
+        callback is called before getaddrinfo returns
 
         Arguments:
             hostname - hostname to look up
-            callback - function to call with result. Result will passed in as a parameter
+            callback - function to call on the loop thread with the list of addresses, most preferred first.
+                       The list is empty if the lookup failed or the resolver queue is full
         """
-        thread = threading.Thread(target=functools.partial(Connector._gethostbyname_lookup, hostname=hostname, callback=callback))
-        thread.start()
-        return
+        if self.dns_client is not None:
+            self.dns_client.getaddrinfo(hostname, callback)
+            return
+        addresses = self.resolver.cached(hostname)
+        if addresses is not DnsCache.MISS:
+            callback(addresses or [])
+            return
+        if not self.resolver.submit(hostname, functools.partial(self.call_soon_threadsafe, callback)):
+            self.call_soon_threadsafe(callback, [])
 
-    @staticmethod
-    def _gethostbyname_lookup(hostname, callback):
-        """Lookup address of hostname. This is called in a separate thread.
-        The result is returned in a callback
-        """
-        # This will be called in a thread
-        addr = socket.gethostbyname(hostname)
-        callback(addr)
+    def gethostbyname(self, hostname, callback):
+        """Non-blocking version of gethostbyname(). Calls callback on the loop thread with the first IPv4
+        address found by getaddrinfo, or None if there is none"""
+        self.getaddrinfo(hostname, lambda addresses: callback(next((a for a in addresses if ":" not in a), None)))
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) on the loop thread after delay seconds.
+        Returns a Timer whose cancel method stops the call"""
+        return self.timers.call_later(delay, callback, *args)
+
+    def schedule_flush(self, protocol):
+        """Called by a protocol that has buffered writes while coalescing. The protocol's writer is called
+        at the end of the loop iteration"""
+        self._pending_flushes.append(protocol)
+
+    def schedule_read(self, callback):
+        """Called when reading stopped with data possibly left in a socket. With an edge triggered selector
+        the socket will not be reported again, so callback is called with no arguments next iteration"""
+        self._pending_reads.append(callback)
 
     def start(self):
-        """Starts processing network events"""
-        while True:
-            events = self.selector.select()
-            for key, mask in events:
-                # Function called on a network event is stored in data field of key
-                callback = key.data
+        """Starts processing network events, until stop is called"""
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        """Make start return after the current loop iteration. May be called from any thread"""
+        self._running = False
+        self._waker.wake()
+
+    def run_once(self, timeout=None):
+        """Wait for network events and handle them, then call expired timers.
+        Ready connections are handled in turn, starting one further along the list each iteration,
+        so the connection at the front of the selector's list is not always served first.
+        If loop_stats is set, the wait, each callback and the whole iteration are timed and recorded in it.
+
+        Arguments:
+        timeout -- seconds to wait for an event. None waits until there is one. The wait ends early
+                   if a timer is due
+        """
+        if self._pending_reads:
+            timeout = 0
+        elif self.timers:
+            timer_timeout = self.timers.timeout()
+            if timeout is None or timer_timeout < timeout:
+                timeout = timer_timeout
+        stats = self.loop_stats
+        if stats is None:
+            call = None
+        else:
+            # Callbacks are run through call, which times them
+            call = functools.partial(Connector._timed_call, stats)
+            start = stats.clock()
+        if self.edge_triggered:
+            events = self.selector.poll(timeout)
+        else:
+            events = self.selector.select(timeout)
+        if stats is not None:
+            stats.record_select(stats.clock() - start, len(events))
+        if self.edge_triggered:
+            self._handle_epoll_events(events, call)
+        else:
+            self._handle_selector_events(events, call)
+        self.timers.advance(None if call is None else functools.partial(call, "timer"))
+        self.coalescing = False
+        self._flush_writes(call)
+        if stats is not None:
+            stats.record_iteration(stats.clock() - start)
+
+    def _rotate(self, events):
+        if len(events) > 1:
+            self._rotation += 1
+            first = self._rotation % len(events)
+            events = events[first:] + events[:first]
+        return events
+
+    def _handle_selector_events(self, events, call=None):
+        self.coalescing = self.coalesce_writes
+        for key, mask in self._rotate(events):
+            # Skip sockets closed by an earlier callback in this iteration. Their file descriptor may already
+            # belong to a new socket, which must not be given the old socket's events
+            if key.fileobj.fileno() < 0:
+                continue
+            # Function called on a network event is stored in data field of key
+            callback = key.data
+            if call is None:
                 callback(key.fileobj, mask)
+            else:
+                call(self._event_kind(callback, mask), callback, (key.fileobj, mask))
+
+    def _handle_epoll_events(self, events, call=None):
+        # Reads scheduled in the last iteration. Those scheduled in this iteration wait for the next
+        pending_reads = self._pending_reads
+        self._pending_reads = []
+        self.coalescing = self.coalesce_writes
+        selector_events = EdgeTriggeredSelector.selector_events
+        for registration, epoll_events in self._rotate(events):
+            # Skip sockets unregistered by an earlier callback in this iteration. Their file descriptor may
+            # already belong to a new socket, which must not be given the old socket's events
+            if registration.registered:
+                callback = registration.callback
+                mask = selector_events(epoll_events)
+                if call is None:
+                    callback(registration.fileobj, mask)
+                else:
+                    call(self._event_kind(callback, mask), callback, (registration.fileobj, mask))
+        for callback in pending_reads:
+            if call is None:
+                callback()
+            else:
+                call(self._event_kind(callback, selectors.EVENT_READ), callback, ())
+
+    @staticmethod
+    def _timed_call(stats, kind, callback, args):
+        """Call callback(*args), recording its duration in stats as a callback of type kind"""
+        clock = stats.clock
+        begin = clock()
+        callback(*args)
+        stats.record(kind, clock() - begin, getattr(callback, "__self__", callback))
+
+    @staticmethod
+    def _event_kind(callback, mask):
+        """Type of callback, as recorded in LoopStats, when called for the selector events in mask"""
+        protocol = getattr(callback, "__self__", None)
+        if isinstance(protocol, Protocol):
+            if protocol._state is Protocol._CONNECTING:
+                return "connect"
+            return "read" if mask & selectors.EVENT_READ else "write"
+        function = getattr(getattr(callback, "func", callback), "__func__", None)
+        if function is Connector.accept:
+            return "accept"
+        if function is Connector._wakeup:
+            return "wakeup"
+        if function is ConnectionRace._attempt_ready:
+            return "connect"
+        return "other"
+
+    def _flush_writes(self, call=None):
+        """Write data buffered by protocols during this loop iteration.
+        All writes made to a connection go out together, in one sendmsg where possible"""
+        if self._pending_flushes:
+            pending_flushes = self._pending_flushes
+            self._pending_flushes = []
+            for protocol in pending_flushes:
+                if call is None:
+                    protocol._flush()
+                else:
+                    call("write", protocol._flush, ())
 
     def shutdown(self):
         logger.debug("Shutting down")
+        if self.dns_client is not None:
+            self.dns_client.close()
         self.selector.close()
+        self._waker.close()
 
@@ -0,0 +1,94 @@
+import collections
+import threading
+import time
+
+
+class DnsCache:
+    """Cache of host name lookups, shared by the event loops of a process.
+
+    Each name maps to its list of addresses, kept for their TTL, capped at max_ttl. Lookups that return no
+    TTL, such as those made with socket.getaddrinfo, are kept for ttl. Failed lookups are cached as None for
+    negative_ttl, so a name that does not resolve is not looked up again for every request. Memory is capped
+    by keeping at most max_entries names, evicting the least recently used. Host names are case insensitive.
+    """
+
+    # Returned by get when a name is not cached, as None is a cached failure
+    MISS = object()
+
+    def __init__(self, max_entries=10000, ttl=60.0, max_ttl=3600.0, negative_ttl=5.0, clock=time.monotonic):
+        """Arguments:
+        max_entries -- most names cached. Each takes a few hundred bytes
+        ttl -- seconds to keep addresses whose lookup gave no TTL
+        max_ttl -- most seconds to keep any addresses
+        negative_ttl -- seconds to remember that a lookup failed. 0 to not cache failures
+        clock -- function returning the time in seconds
+        """
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._max_ttl = max_ttl
+        self._negative_ttl = negative_ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()    # hostname -> (addresses, expiry), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0               # Number of lookups answered with an address
+        self.negative_hits = 0      # Number of lookups answered with a cached failure
+        self.misses = 0             # Number of lookups not cached, or expired
+        self.evictions = 0          # Number of names removed to stay within max_entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(hostname):
+        """Return the form of hostname used as a key, so names differing only in case are the same"""
+        return hostname.lower().rstrip(".")
+
+    def get(self, hostname):
+        """Return the cached list of addresses of hostname, None if its lookup failed recently, or MISS"""
+        key = DnsCache.normalize(hostname)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return DnsCache.MISS
+            addresses, expiry = entry
+            if expiry <= self._clock():
+                del self._entries[key]
+                self.misses += 1
+                return DnsCache.MISS
+            self._entries.move_to_end(key)
+            if addresses is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return addresses
+
+    def put(self, hostname, addresses, ttl=None):
+        """Cache the result of looking up hostname. addresses is a list of addresses, or None if the lookup
+        failed. ttl is the lowest time to live of the records in seconds, if the lookup gave one"""
+        if addresses is None:
+            ttl = self._negative_ttl
+        elif ttl is None:
+            ttl = self._ttl
+        else:
+            ttl = min(ttl, self._max_ttl)
+        if ttl <= 0 or self._max_entries <= 0:
+            return
+        key = DnsCache.normalize(hostname)
+        with self._lock:
+            self._entries[key] = (addresses, self._clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Return a dictionary of cache statistics"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
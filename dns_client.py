@@ -0,0 +1,488 @@
+import collections
+import errno
+import functools
+import ipaddress
+import logging
+import os
+import selectors
+import socket
+import struct
+from dns_cache import DnsCache
+from errors import ProtocolError
+
+logger = logging.getLogger(__name__)
+
+
+class DnsMessage:
+    """Static methods for the small part of the DNS wire format (RFC 1035) used by DnsClient"""
+
+    TYPE_A = 1
+    TYPE_CNAME = 5
+    TYPE_AAAA = 28
+    CLASS_IN = 1
+
+    RCODE_NOERROR = 0
+    RCODE_SERVFAIL = 2
+    RCODE_NXDOMAIN = 3
+
+    FLAG_RESPONSE = 0x8000
+    FLAG_TRUNCATED = 0x0200
+    FLAG_RECURSION_DESIRED = 0x0100
+
+    HEADER = struct.Struct("!HHHHHH")
+    QUESTION = struct.Struct("!HH")
+    RECORD = struct.Struct("!HHIH")
+
+    @staticmethod
+    def encode_name(name):
+        try:
+            labels = name.rstrip(".").encode("idna").split(b".")
+        except UnicodeError as e:
+            # The codec checks label lengths too
+            raise ProtocolError(f"Invalid host name: {name}: {e}")
+        encoded = bytearray()
+        for label in labels:
+            if not 0 < len(label) < 64:
+                raise ProtocolError(f"Invalid host name: {name}")
+            encoded.append(len(label))
+            encoded.extend(label)
+        encoded.append(0)
+        if len(encoded) > 255:
+            raise ProtocolError(f"Host name too long: {name}")
+        return bytes(encoded)
+
+    @staticmethod
+    def encode_query(query_id, name, qtype):
+        """Return a recursive query for records of qtype for name"""
+        return (DnsMessage.HEADER.pack(query_id, DnsMessage.FLAG_RECURSION_DESIRED, 1, 0, 0, 0)
+                + DnsMessage.encode_name(name) + DnsMessage.QUESTION.pack(qtype, DnsMessage.CLASS_IN))
+
+    @staticmethod
+    def decode_name(data, offset):
+        """Return the name at offset, following compression pointers, and the offset after it"""
+        labels = []
+        end = None
+        for _ in range(128):
+            if offset >= len(data):
+                raise ProtocolError("Name runs past end of message")
+            length = data[offset]
+            if length & 0xC0 == 0xC0:
+                if offset + 1 >= len(data):
+                    raise ProtocolError("Name runs past end of message")
+                if end is None:
+                    end = offset + 2
+                offset = ((length & 0x3F) << 8) | data[offset + 1]
+            elif length == 0:
+                return ".".join(labels).lower(), offset + 1 if end is None else end
+            else:
+                labels.append(data[offset + 1:offset + 1 + length].decode("ascii", "replace"))
+                offset += 1 + length
+        raise ProtocolError("Name compression loop")
+
+    @staticmethod
+    def parse_response(data):
+        """Parse a response.
+        Returns (id, rcode, truncated, question name, question type, answers), where answers is a list of
+        (name, type, ttl, value). value is the address for A and AAAA records, the target name for CNAME
+        records and None for others"""
+        if len(data) < DnsMessage.HEADER.size:
+            raise ProtocolError("Response too short")
+        query_id, flags, qdcount, ancount, nscount, arcount = DnsMessage.HEADER.unpack_from(data)
+        if not flags & DnsMessage.FLAG_RESPONSE or qdcount != 1:
+            raise ProtocolError("Not a response to a single question")
+        qname, offset = DnsMessage.decode_name(data, DnsMessage.HEADER.size)
+        qtype, qclass = DnsMessage.QUESTION.unpack_from(data, offset)
+        offset += DnsMessage.QUESTION.size
+        answers = []
+        for _ in range(ancount):
+            name, offset = DnsMessage.decode_name(data, offset)
+            if offset + DnsMessage.RECORD.size > len(data):
+                raise ProtocolError("Record runs past end of message")
+            rtype, rclass, ttl, rdlength = DnsMessage.RECORD.unpack_from(data, offset)
+            offset += DnsMessage.RECORD.size
+            rdata = data[offset:offset + rdlength]
+            if len(rdata) != rdlength:
+                raise ProtocolError("Record runs past end of message")
+            value = None
+            if rtype == DnsMessage.TYPE_A and rdlength == 4:
+                value = socket.inet_ntop(socket.AF_INET, rdata)
+            elif rtype == DnsMessage.TYPE_AAAA and rdlength == 16:
+                value = socket.inet_ntop(socket.AF_INET6, rdata)
+            elif rtype == DnsMessage.TYPE_CNAME:
+                value = DnsMessage.decode_name(data, offset)[0]
+            answers.append((name, rtype, ttl, value))
+            offset += rdlength
+        return query_id, flags & 0x000F, bool(flags & DnsMessage.FLAG_TRUNCATED), qname, qtype, answers
+
+    @staticmethod
+    def addresses(qname, qtype, answers):
+        """Return the addresses of type qtype for qname, following CNAME records, and the lowest TTL on the
+        way to them"""
+        name = qname
+        ttl = None
+        for _ in range(8):
+            addresses = [(value, record_ttl) for record_name, rtype, record_ttl, value in answers
+                         if record_name == name and rtype == qtype and value is not None]
+            if addresses:
+                lowest = min(record_ttl for value, record_ttl in addresses)
+                return [value for value, record_ttl in addresses], lowest if ttl is None else min(ttl, lowest)
+            cnames = [(value, record_ttl) for record_name, rtype, record_ttl, value in answers
+                      if record_name == name and rtype == DnsMessage.TYPE_CNAME]
+            if not cnames:
+                break
+            name, cname_ttl = cnames[0]
+            ttl = cname_ttl if ttl is None else min(ttl, cname_ttl)
+        return [], ttl
+
+
+def read_resolv_conf(path="/etc/resolv.conf"):
+    """Return the nameservers, as (address, port) pairs, and the timeout and attempts options from a
+    resolv.conf file. Uses the resolver defaults, a server on this host, 5 seconds and 2 attempts,
+    for anything the file does not give"""
+    nameservers = []
+    timeout = 5.0
+    attempts = 2
+    try:
+        with open(path) as resolv_conf:
+            for line in resolv_conf:
+                fields = line.split("#", 1)[0].split(";", 1)[0].split()
+                if len(fields) >= 2 and fields[0] == "nameserver" and len(nameservers) < 3:
+                    try:
+                        nameservers.append((str(ipaddress.ip_address(fields[1].split("%", 1)[0])), 53))
+                    except ValueError:
+                        logger.warning(f"Ignoring nameserver {fields[1]} in {path}")
+                elif fields and fields[0] == "options":
+                    for option in fields[1:]:
+                        name, _, value = option.partition(":")
+                        if name == "timeout" and value.isdigit():
+                            timeout = float(min(int(value), 30))
+                        elif name == "attempts" and value.isdigit():
+                            attempts = min(max(int(value), 1), 5)
+    except OSError as e:
+        logger.warning(f"Unable to read {path}: {e}")
+    return nameservers or [("127.0.0.1", 53)], timeout, attempts
+
+
+def read_hosts(path="/etc/hosts"):
+    """Return a dictionary of host name to list of addresses from a hosts file"""
+    hosts = {}
+    try:
+        with open(path) as hosts_file:
+            for line in hosts_file:
+                fields = line.split("#", 1)[0].split()
+                if len(fields) < 2:
+                    continue
+                try:
+                    addr = str(ipaddress.ip_address(fields[0].split("%", 1)[0]))
+                except ValueError:
+                    continue
+                for name in fields[1:]:
+                    addresses = hosts.setdefault(DnsCache.normalize(name), [])
+                    if addr not in addresses:
+                        addresses.append(addr)
+    except OSError as e:
+        logger.debug(f"Unable to read {path}: {e}")
+    return hosts
+
+
+class _Query:
+    """A query sent by DnsClient and waiting for its response"""
+
+    __slots__ = ("query_id", "name", "qtype", "message", "callbacks", "tries", "timer", "sock")
+
+    def __init__(self, query_id, name, qtype, message):
+        self.query_id = query_id
+        self.name = name
+        self.qtype = qtype
+        self.message = message
+        self.callbacks = []     # Called with (addresses, ttl) when the query is answered
+        self.tries = 0          # Number of times the query has been sent
+        self.timer = None       # Retransmit timer
+        self.sock = None        # UDP socket the query was last sent from, connected to the nameserver
+
+
+class _Lookup:
+    """A DnsClient.getaddrinfo call waiting for its AAAA and A queries"""
+
+    __slots__ = ("hostname", "callback", "ipv6", "ipv4", "ttl", "timer", "done")
+
+    def __init__(self, hostname, callback):
+        self.hostname = hostname
+        self.callback = callback    # Called with the addresses found
+        self.ipv6 = None            # Addresses from the AAAA query. None until answered
+        self.ipv4 = None            # Addresses from the A query. None until answered
+        self.ttl = None             # Lowest TTL of the records used
+        self.timer = None           # Resolution delay timer, started when one query is answered with addresses
+        self.done = False
+
+
+class DnsClient:
+    """Non-blocking DNS stub resolver that runs on a Connector's event loop, with no threads.
+
+    Sends A and AAAA queries over UDP to the nameservers in /etc/resolv.conf, in turn, resending on the
+    loop's timers until the resolver's attempts are used up. Each time a query is sent it goes from a
+    new socket on a random ephemeral port, connected to the nameserver, so a forged response has to
+    guess the port as well as the query ID (RFC 5452). Responses are matched to queries by socket, ID,
+    nameserver address and question. Names in /etc/hosts and address literals are answered without a
+    query, and concurrent queries for the same name and type share one query. The limits count
+    getaddrinfo lookups, each an AAAA and an A query: at most max_in_flight lookups, and so twice as
+    many sockets, are outstanding at once. Further queries wait, up to max_queue lookups' worth, and
+    beyond that fail at once. Search domains are not applied and truncated responses are used as far as
+    they go, without a retry over TCP.
+
+    getaddrinfo has the interface of Connector.getaddrinfo. With a DnsCache, addresses are cached for the
+    TTL of their records.
+    """
+
+    MAX_RESPONSE = 4096
+
+    # Seconds to wait for the AAAA or A response once the other has given addresses
+    RESOLUTION_DELAY = 0.05
+
+    def __init__(self, connector, nameservers=None, timeout=None, attempts=None, cache=None, hosts=None,
+                 max_in_flight=256, max_queue=4096):
+        """Arguments:
+        connector -- the Connector whose loop the client runs on
+        nameservers -- (address, port) pairs. Defaults to those in /etc/resolv.conf
+        timeout -- seconds to wait for a response before resending. Defaults to the resolv.conf option
+        attempts -- number of times each nameserver is tried. Defaults to the resolv.conf option
+        cache -- a DnsCache shared with other clients or a ResolverPool. None for no caching
+        hosts -- dictionary of host name to addresses. Defaults to those in /etc/hosts
+        max_in_flight -- most lookups sent and waiting for a response. Each holds two sockets
+        max_queue -- most lookups waiting to be sent. Further lookups fail
+        """
+        conf_nameservers, conf_timeout, conf_attempts = read_resolv_conf()
+        self._connector = connector
+        self._nameservers = [(str(ipaddress.ip_address(addr)), port) for addr, port in nameservers or conf_nameservers]
+        self._timeout = timeout if timeout is not None else conf_timeout
+        self._attempts = attempts if attempts is not None else conf_attempts
+        self.cache = cache
+        self._hosts = hosts if hosts is not None else read_hosts()
+        self._queries = {}      # Query ID -> _Query
+        self._by_name = {}      # (name, type) -> _Query
+        self._waiting = collections.deque()     # Queries not yet sent, in the order made
+        # In queries, two to a lookup
+        self._max_in_flight = 2 * max_in_flight
+        self._max_queue = 2 * max_queue
+        self.queries = 0        # Number of queries started
+        self.coalesced = 0      # Number of lookups that joined a query already in flight
+        self.retransmits = 0    # Number of times a query was resent
+        self.timeouts = 0       # Number of queries with no answer after every attempt
+        self.rejected = 0       # Number of lookups failed because too many queries were waiting
+        self.failed = 0         # Number of queries answered with no address
+        self.hosts_hits = 0     # Number of lookups answered from the hosts file or an address literal
+        self.resolution_delays = 0  # Number of lookups finished before both the AAAA and A responses came
+
+    def getaddrinfo(self, hostname, callback):
+        """Look up the IPv6 and IPv4 addresses of hostname, sending the AAAA and A queries together.
+        callback is called on the loop thread with a list of addresses, IPv6 first, empty if the lookup failed.
+        It is called before getaddrinfo returns if the answer is known. Once either response has given
+        addresses, the other is waited for for at most RESOLUTION_DELAY seconds (RFC 8305 section 3)"""
+        if self.cache is not None:
+            addresses = self.cache.get(hostname)
+            if addresses is not DnsCache.MISS:
+                callback(addresses or [])
+                return
+        lookup = _Lookup(hostname, callback)
+        self.resolve(hostname, DnsMessage.TYPE_AAAA, functools.partial(self._answered, lookup, DnsMessage.TYPE_AAAA))
+        self.resolve(hostname, DnsMessage.TYPE_A, functools.partial(self._answered, lookup, DnsMessage.TYPE_A))
+
+    def _answered(self, lookup, qtype, addresses, ttl):
+        if lookup.done:
+            return
+        if ttl is not None:
+            lookup.ttl = ttl if lookup.ttl is None else min(lookup.ttl, ttl)
+        if qtype == DnsMessage.TYPE_AAAA:
+            lookup.ipv6 = addresses
+        else:
+            lookup.ipv4 = addresses
+        if lookup.ipv6 is not None and lookup.ipv4 is not None:
+            self._lookup_done(lookup)
+        elif addresses:
+            # Wait a little for the other response rather than for all its retransmits
+            lookup.timer = self._connector.call_later(DnsClient.RESOLUTION_DELAY, self._lookup_done, lookup)
+
+    def _lookup_done(self, lookup):
+        lookup.done = True
+        if lookup.timer is not None:
+            lookup.timer.cancel()
+        addresses = (lookup.ipv6 or []) + (lookup.ipv4 or [])
+        if lookup.ipv6 is None or lookup.ipv4 is None:
+            # Finished without one of the responses. Not cached, so the next lookup can find its addresses
+            self.resolution_delays += 1
+        elif self.cache is not None:
+            self.cache.put(lookup.hostname, addresses or None, lookup.ttl)
+        lookup.callback(addresses)
+
+    def resolve(self, hostname, qtype, callback):
+        """Look up the addresses of type qtype, DnsMessage.TYPE_A or TYPE_AAAA, of hostname.
+        callback is called on the loop thread with a list of addresses, empty if the lookup failed, and
+        the lowest TTL of the records used, None if not known"""
+        family = socket.AF_INET if qtype == DnsMessage.TYPE_A else socket.AF_INET6
+        name = DnsCache.normalize(hostname)
+        try:
+            literal = ipaddress.ip_address(name)
+        except ValueError:
+            pass
+        else:
+            self.hosts_hits += 1
+            callback([str(literal)] if literal.version == (4 if family == socket.AF_INET else 6) else [], None)
+            return
+        if name in self._hosts:
+            self.hosts_hits += 1
+            callback([addr for addr in self._hosts[name] if (":" in addr) == (family == socket.AF_INET6)], None)
+            return
+
+        try:
+            # Internationalised names are sent, and come back in responses, in their ASCII form
+            name = name.encode("idna").decode("ascii")
+        except UnicodeError as e:
+            logger.debug(f"Unable to look up {hostname}: {e}")
+            callback([], None)
+            return
+        query = self._by_name.get((name, qtype))
+        if query is not None:
+            self.coalesced += 1
+            query.callbacks.append(callback)
+            return
+        if len(self._waiting) >= self._max_queue:
+            self.rejected += 1
+            callback([], None)
+            return
+        query_id = self._new_id()
+        try:
+            message = DnsMessage.encode_query(query_id, name, qtype)
+        except ProtocolError as e:
+            logger.debug(f"Unable to look up {hostname}: {e}")
+            callback([], None)
+            return
+        query = _Query(query_id, name, qtype, message)
+        query.callbacks.append(callback)
+        self._queries[query_id] = query
+        self._by_name[(name, qtype)] = query
+        self.queries += 1
+        if len(self._queries) - len(self._waiting) <= self._max_in_flight:
+            self._send(query)
+        else:
+            self._waiting.append(query)
+
+    def _new_id(self):
+        while True:
+            query_id = int.from_bytes(os.urandom(2), "big")
+            if query_id not in self._queries:
+                return query_id
+
+    def _open_socket(self, query, server):
+        """Replace the query's socket with a new one connected to server. The kernel picks a random port"""
+        self._close_socket(query)
+        sock = socket.socket(socket.AF_INET6 if ":" in server[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.connect(server)
+            self._connector.selector.register(sock, selectors.EVENT_READ, functools.partial(self._read, query))
+        except (OSError, ValueError, KeyError):
+            sock.close()
+            raise
+        self._connector.connections += 1
+        query.sock = sock
+        return sock
+
+    def _close_socket(self, query):
+        if query.sock is not None:
+            try:
+                self._connector.selector.unregister(query.sock)
+            except (ValueError, KeyError):
+                pass
+            query.sock.close()
+            self._connector.connections -= 1
+            query.sock = None
+
+    def _send(self, query):
+        """Send query to the next nameserver and set its retransmit timer. Finish it once every attempt is used"""
+        if query.tries >= self._attempts * len(self._nameservers):
+            self.timeouts += 1
+            logger.debug(f"Lookup of {query.name} timed out")
+            self._finish(query, [], None)
+            return
+        server = self._nameservers[query.tries % len(self._nameservers)]
+        if query.tries > 0:
+            self.retransmits += 1
+        query.tries += 1
+        try:
+            self._open_socket(query, server).send(query.message)
+        except (OSError, ValueError, KeyError) as e:
+            # Unreachable nameserver, out of descriptors or no buffer space. The timer tries the next one
+            logger.debug(f"Unable to send query for {query.name} to {server[0]}: {e}")
+        query.timer = self._connector.call_later(self._timeout, self._send, query)
+
+    def _read(self, query, sock, mask):
+        """Called when a query's socket is readable. Reads until it would block, as the selector may be edge
+        triggered, or until the query is finished"""
+        while query.sock is sock:
+            try:
+                data, addr = sock.recvfrom(DnsClient.MAX_RESPONSE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # ICMP port unreachable from the nameserver is reported here. The retransmit timer handles it
+                if e.errno != errno.ECONNREFUSED:
+                    logger.debug(f"DNS socket error: {e}")
+                continue
+            self._response(query, data, addr)
+
+    def _response(self, query, data, addr):
+        try:
+            query_id, rcode, truncated, qname, qtype, answers = DnsMessage.parse_response(data)
+        except (ProtocolError, struct.error, ValueError) as e:
+            logger.debug(f"Ignoring malformed DNS response from {addr[0]}: {e}")
+            return
+        if query_id != query.query_id or qname != query.name or qtype != query.qtype \
+                or (str(ipaddress.ip_address(addr[0].split("%", 1)[0])), addr[1]) not in self._nameservers:
+            logger.debug(f"Ignoring unexpected DNS response from {addr[0]}")
+            return
+        if rcode not in (DnsMessage.RCODE_NOERROR, DnsMessage.RCODE_NXDOMAIN):
+            # Server failed or refused. Try the next one straight away
+            query.timer.cancel()
+            self._send(query)
+            return
+        if truncated:
+            logger.debug(f"Truncated DNS response for {query.name}: using the records received")
+        addresses, ttl = DnsMessage.addresses(query.name, query.qtype, answers)
+        self._finish(query, addresses, ttl)
+
+    def _finish(self, query, addresses, ttl):
+        if query.timer is not None:
+            query.timer.cancel()
+        self._close_socket(query)
+        del self._queries[query.query_id]
+        del self._by_name[(query.name, query.qtype)]
+        if not addresses:
+            self.failed += 1
+        if self._waiting:
+            self._send(self._waiting.popleft())
+        for callback in query.callbacks:
+            callback(addresses, ttl)
+
+    def stats(self):
+        """Return a dictionary of client statistics"""
+        stats = {
+            "queries": self.queries,
+            "in_flight": len(self._queries) - len(self._waiting),
+            "waiting": len(self._waiting),
+            "rejected": self.rejected,
+            "coalesced": self.coalesced,
+            "retransmits": self.retransmits,
+            "timeouts": self.timeouts,
+            "failed": self.failed,
+            "hosts_hits": self.hosts_hits,
+            "resolution_delays": self.resolution_delays,
+        }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        for query in self._queries.values():
+            if query.timer is not None:
+                query.timer.cancel()
+            self._close_socket(query)
@@ -11,8 +11,11 @@ class EchoProtocolFactory(ProtocolFactory):
 
 class Echo(Protocol):
     """Echo server. This is an example to show how easy it should be to write a server"""
+
+    __slots__ = ()
+
     def data_received(self, data):
-        logging.info(f"data_received: {data}")
+        logging.info(f"data_received: {bytes(data)}")
         self.write(data)
 
     def connection_lost(self):
@@ -0,0 +1,102 @@
+import select
+import selectors
+
+
+class Registration:
+    """A file object registered with EdgeTriggeredSelector, and its callback"""
+
+    __slots__ = ("fileobj", "callback", "registered")
+
+    def __init__(self, fileobj, callback):
+        self.fileobj = fileobj
+        self.callback = callback
+        self.registered = True      # False once unregistered. Events polled before then are stale
+
+
+class EdgeTriggeredSelector:
+    """Edge triggered epoll selector (Linux only).
+
+    Provides register, modify, unregister and close with the same arguments and errors as the
+    selectors module, so Protocol can use either. Registrations are kept in a list indexed by file
+    descriptor, and poll pairs each of epoll's events with the registration current when it returned.
+    A handler may close a socket and a later handler in the same batch open one that reuses its file
+    descriptor, so events whose registration has since been unregistered must be skipped.
+
+    Edge triggered means readiness is reported once each time it changes. Handlers must read or
+    write until the socket would block, or ask the connector to call them again.
+    """
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self.registrations = []     # Registration of each file descriptor. None if not registered
+
+    @staticmethod
+    def _fileno(fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        if fd < 0:
+            raise ValueError(f"Invalid file descriptor: {fd}")
+        return fd
+
+    @staticmethod
+    def _epoll_events(events):
+        epoll_events = select.EPOLLET
+        if events & selectors.EVENT_READ:
+            epoll_events |= select.EPOLLIN
+        if events & selectors.EVENT_WRITE:
+            epoll_events |= select.EPOLLOUT
+        return epoll_events
+
+    @staticmethod
+    def selector_events(epoll_events):
+        """Convert epoll events to EVENT_READ and EVENT_WRITE. Errors and hang ups are reported as both,
+        as selectors.EpollSelector does, so whichever handler is waiting sees them"""
+        events = 0
+        if epoll_events & ~select.EPOLLIN:
+            events |= selectors.EVENT_WRITE
+        if epoll_events & ~select.EPOLLOUT:
+            events |= selectors.EVENT_READ
+        return events
+
+    def _registered(self, fd):
+        return fd < len(self.registrations) and self.registrations[fd] is not None
+
+    def register(self, fileobj, events, data=None):
+        fd = self._fileno(fileobj)
+        if self._registered(fd):
+            raise KeyError(f"{fileobj!r} (FD {fd}) is already registered")
+        if data is None:
+            raise ValueError("A callback is required")
+        self._epoll.register(fd, self._epoll_events(events))
+        if fd >= len(self.registrations):
+            self.registrations.extend([None] * (fd + 1 - len(self.registrations)))
+        self.registrations[fd] = Registration(fileobj, data)
+
+    def modify(self, fileobj, events, data=None):
+        fd = self._fileno(fileobj)
+        if not self._registered(fd):
+            raise KeyError(f"{fileobj!r} is not registered")
+        self._epoll.modify(fd, self._epoll_events(events))
+        if data is not None:
+            self.registrations[fd].callback = data
+
+    def unregister(self, fileobj):
+        fd = self._fileno(fileobj)
+        if not self._registered(fd):
+            raise KeyError(f"{fileobj!r} is not registered")
+        self.registrations[fd].registered = False
+        self.registrations[fd] = None
+        try:
+            self._epoll.unregister(fd)
+        except OSError:
+            # File descriptor was closed without being unregistered
+            pass
+
+    def poll(self, timeout=None):
+        """Wait for events. Returns a list of (Registration, epoll events). Skip those whose registration
+        is no longer registered when they are handled. timeout is in seconds, None to wait forever"""
+        registrations = self.registrations
+        return [(registrations[fd], events) for fd, events in self._epoll.poll(-1 if timeout is None else timeout)]
+
+    def close(self):
+        self._epoll.close()
+        self.registrations = []
@@ -0,0 +1,144 @@
+import logging
+import os
+import selectors
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Handoff:
+    """Restarts the proxy without refusing connections or cutting established tunnels (POSIX only).
+
+    The running process listens on a UNIX socket at path. A new process started with the same path connects
+    to it and is sent the listening sockets, the UNIX socket's own listener first, with SCM_RIGHTS. Both
+    processes then accept from the same listen queues. Once the new process is serving it replies READY and
+    the old process closes its copies of the listening sockets, so connections waiting in the queues are
+    accepted by the new process. The old process carries on relaying its tunnels until they have all closed
+    or drain_timeout has passed, then stops its loops. If the new process fails before replying the old
+    process keeps serving.
+    """
+
+    READY = b"ready"
+    MAX_SOCKETS = 16
+    DRAIN_CHECK_INTERVAL = 0.5
+
+    def __init__(self, path, drain_timeout=60.0):
+        """Arguments:
+        path -- file system path of the UNIX socket used to pass the listening sockets on
+        drain_timeout -- most seconds the old process waits for its tunnels to close before exiting
+        """
+        self.path = path
+        self.drain_timeout = drain_timeout
+        self._listener = None       # UNIX socket listening at path
+        self._old_process = None    # Connection to the process being replaced, until it is told we are ready
+        self._loops = None
+        self._sockets = None        # Listening sockets passed on to a new process
+        self._deadline = None
+
+    def take_over(self):
+        """Connect to the process running at path and take its listening sockets.
+        Returns the listening sockets other than the UNIX one, or None if no process is running there,
+        in which case the caller creates its own"""
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            conn.close()
+            return None
+        try:
+            msg, fds, flags, addr = socket.recv_fds(conn, 1024, Handoff.MAX_SOCKETS)
+        except OSError:
+            conn.close()
+            raise
+        if not fds:
+            conn.close()
+            raise ConnectionError(f"No listening sockets received from {self.path}")
+        logger.info(f"Took over {len(fds)} listening sockets from {self.path}")
+        self._listener = socket.socket(fileno=fds[0])
+        self._old_process = conn
+        return [socket.socket(fileno=fd) for fd in fds[1:]]
+
+    def serve(self, loops, sockets):
+        """Listen for a process taking over from this one, and tell the process replaced, if any, that this
+        one is serving.
+
+        Arguments:
+        loops -- the Connectors of this process. The first owns the listening sockets
+        sockets -- the listening sockets to pass on
+        """
+        self._loops = loops
+        self._sockets = sockets
+        if self._listener is None:
+            self._listener = self._bind()
+        self._listener.setblocking(False)
+        loops[0].selector.register(self._listener, selectors.EVENT_READ, self._accept)
+        if self._old_process is not None:
+            try:
+                self._old_process.sendall(Handoff.READY)
+            except OSError as e:
+                logger.warning(f"Unable to tell the old process to stop accepting: {e}")
+            self._old_process.close()
+            self._old_process = None
+
+    def _bind(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # Left behind by a process that has exited, as take_over found no process listening
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        listener.bind(self.path)
+        listener.listen()
+        return listener
+
+    def _accept(self, listener, mask):
+        while self._listener is not None:
+            try:
+                conn, addr = listener.accept()
+            except BlockingIOError:
+                return
+            try:
+                socket.send_fds(conn, [b"listeners"], [listener.fileno()] + [sock.fileno() for sock in self._sockets])
+            except OSError as e:
+                logger.warning(f"Unable to pass listening sockets on: {e}")
+                conn.close()
+                continue
+            logger.info("Passed listening sockets to a new process")
+            conn.setblocking(False)
+            self._loops[0].selector.register(conn, selectors.EVENT_READ, self._new_process_ready)
+
+    def _new_process_ready(self, conn, mask):
+        try:
+            reply = conn.recv(len(Handoff.READY))
+        except BlockingIOError:
+            return
+        except OSError:
+            reply = b""
+        self._loops[0].selector.unregister(conn)
+        conn.close()
+        if reply != Handoff.READY:
+            logger.warning("New process exited before it started serving. Carrying on accepting connections")
+            return
+        if self._listener is None:
+            return
+        self._loops[0].selector.unregister(self._listener)
+        # Leave path in place: the new process is listening on it
+        self._listener.close()
+        self._listener = None
+        self._loops[0].stop_accepting()
+        self._deadline = time.monotonic() + self.drain_timeout
+        logger.info(f"New process is serving. Draining tunnels for up to {self.drain_timeout}s")
+        self._drain()
+
+    def _drain(self):
+        connections = sum(loop.connections for loop in self._loops)
+        if connections and time.monotonic() < self._deadline:
+            self._loops[0].call_later(Handoff.DRAIN_CHECK_INTERVAL, self._drain)
+            return
+        if connections:
+            logger.warning(f"Drain timeout passed: closing {connections} connections")
+        else:
+            logger.info("All tunnels closed")
+        for loop in self._loops:
+            loop.stop()
@@ -0,0 +1,140 @@
+import collections
+import errno
+import logging
+import selectors
+import socket
+
+logger = logging.getLogger(__name__)
+
+
+def interleave(addresses):
+    """Return addresses reordered to alternate between IPv6 and IPv4, starting with the family of the
+    first address and otherwise keeping their order (RFC 8305 section 4)"""
+    first = [addr for addr in addresses if (":" in addr) == (":" in addresses[0])]
+    second = [addr for addr in addresses if (":" in addr) != (":" in addresses[0])]
+    reordered = []
+    for i in range(max(len(first), len(second))):
+        reordered.extend(family[i] for family in (first, second) if i < len(family))
+    return reordered
+
+
+class ConnectionRace:
+    """Connects a Protocol to whichever of several addresses of a host answers first (RFC 8305).
+
+    Addresses are tried in interleaved family order. Each attempt gets delay seconds before the next one
+    starts alongside it, and an attempt that fails starts the next straight away, so a dead or unreachable
+    address costs at most delay rather than a whole connect timeout. The first socket to connect is handed
+    to the protocol and the other attempts are closed. Closing the protocol before then, for example on a
+    connect timeout, cancels the race.
+    """
+
+    def __init__(self, connector, addresses, port, protocol, on_failure=None, delay=0.25):
+        """Arguments:
+        connector -- the Connector whose loop the attempts run on
+        addresses -- IPv6 and IPv4 addresses of the host, most preferred first
+        port -- the remote server port
+        protocol -- the Protocol instance given the winning connection
+        on_failure -- function to call if every attempt fails
+        delay -- seconds to wait for an attempt before starting the next (Connection Attempt Delay)
+        """
+        self._connector = connector
+        self._addresses = collections.deque(interleave(addresses))
+        self._port = port
+        self._protocol = protocol
+        self._on_failure = on_failure
+        self._delay = delay
+        self._attempts = []     # Sockets still connecting
+        self._timer = None      # Starts the next attempt if the current ones are slow
+
+    def start(self):
+        self._protocol._connection_racing(self._connector, self)
+        self._next_attempt()
+
+    def close(self):
+        """Stop the race, closing every attempt, and call on_failure"""
+        self._cancel()
+        self._failed()
+
+    def _cancel(self):
+        self._addresses.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for sock in self._attempts[:]:
+            self._release(sock)
+
+    def _next_attempt(self):
+        """Start connecting to the next address that gets as far as connecting. Fails the race if there
+        are none left and no attempt is still connecting"""
+        self._timer = None
+        while self._addresses:
+            if self._connect(self._addresses.popleft()):
+                if self._addresses:
+                    self._timer = self._connector.call_later(self._delay, self._next_attempt)
+                return
+        if not self._attempts:
+            logger.debug(f"Every connection attempt to port {self._port} failed")
+            self._failed()
+
+    def _connect(self, addr):
+        try:
+            sock = socket.socket(socket.AF_INET6 if ":" in addr else socket.AF_INET, socket.SOCK_STREAM)
+        except OSError as e:
+            # Out of descriptors, or the address family is not supported
+            logger.warning(f"Unable to create socket: {e}")
+            return False
+        sock.setblocking(False)
+        error = sock.connect_ex((addr, self._port))
+        if error not in (0, errno.EINPROGRESS):
+            # For example no route to an IPv6 address on a host without IPv6
+            logger.debug(f"Connect to {addr}:{self._port} failed: {errno.errorcode.get(error, error)}")
+            sock.close()
+            return False
+        try:
+            self._connector.selector.register(sock, selectors.EVENT_WRITE, self._attempt_ready)
+        except (ValueError, KeyError) as e:
+            logger.debug(f"Selector registration error: {e}")
+            sock.close()
+            return False
+        self._connector.connections += 1
+        self._attempts.append(sock)
+        return True
+
+    def _release(self, sock):
+        try:
+            self._connector.selector.unregister(sock)
+        except (ValueError, KeyError):
+            pass
+        sock.close()
+        self._connector.connections -= 1
+        self._attempts.remove(sock)
+
+    def _attempt_ready(self, sock, mask):
+        """Called when an attempt's socket is writable, once it has connected or failed"""
+        if sock not in self._attempts:
+            # Closed by another attempt that connected earlier in the same loop iteration
+            return
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            logger.debug(f"{sock.fileno()}:connect failed: {errno.errorcode.get(error, error)}")
+            self._release(sock)
+            # Start the next attempt now rather than when the timer fires
+            if self._timer is not None:
+                self._timer.cancel()
+            self._next_attempt()
+            return
+        try:
+            self._connector.selector.unregister(sock)
+        except (ValueError, KeyError):
+            pass
+        self._connector.connections -= 1
+        self._attempts.remove(sock)
+        self._cancel()
+        # The protocol registers the socket again, and is told it has connected when it is next writable
+        self._protocol._connection_created(self._connector, self._connector.selector, sock, self._on_failure)
+
+    def _failed(self):
+        self._protocol._connect_race = None
+        self._protocol._set_unconnected()
+        if self._on_failure is not None:
+            self._on_failure()
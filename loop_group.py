@@ -0,0 +1,54 @@
+import logging
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _gil_enabled():
+    """True unless running on a free threaded build of Python (3.13t or later) with the GIL disabled"""
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled is None or is_gil_enabled()
+
+
+class LoopGroup:
+    """Runs several Connector event loops in one process, one per thread.
+
+    The first loop runs on the thread that calls start and owns the listening sockets. It hands each
+    new connection to the loop with the fewest connections, which may be itself. Protocol factories
+    are shared by every loop, so objects they hold, such as the Authenticator, exist once per process.
+
+    Threads only run in parallel on free threaded Python. When the GIL is enabled a single loop is used.
+    """
+
+    def __init__(self, n_loops, connector_factory):
+        """Arguments:
+        n_loops -- number of event loops (threads)
+        connector_factory -- function returning a new Connector for each loop
+        """
+        if n_loops > 1 and _gil_enabled():
+            logger.warning(f"Python is running with the GIL enabled: using 1 event loop rather than {n_loops}")
+            n_loops = 1
+        self.loops = [connector_factory() for _ in range(max(n_loops, 1))]
+
+    def create_server(self, interface, port, protocol_factory, **kwargs):
+        """Create a server whose connections are shared between the loops. Returns the listening socket.
+        See Connector.create_server"""
+        loops = self.loops if len(self.loops) > 1 else None
+        return self.loops[0].create_server(interface, port, protocol_factory, loops=loops, **kwargs)
+
+    def start(self):
+        """Start the other loops in daemon threads, then run the first loop on this thread.
+        Returns once every loop has stopped"""
+        threads = [threading.Thread(target=connector.start, name=f"loop-{index}", daemon=True)
+                   for index, connector in enumerate(self.loops[1:], 1)]
+        for thread in threads:
+            thread.start()
+        self.loops[0].start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        """Stop every loop. May be called from any thread"""
+        for connector in self.loops:
+            connector.stop()
@@ -0,0 +1,127 @@
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Counts of integer values in power of two buckets. Bucket i holds values below 2 ** i and at least
+    2 ** (i - 1), bucket 0 holds 0. Adding a value is a couple of integer operations"""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    N_BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * Histogram.N_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[min(value.bit_length(), Histogram.N_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of values, or 0 if there are none"""
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(1 << index, self.max)
+        return 0
+
+    def snapshot(self):
+        """Return a dictionary summarising the values, with the count in each non-empty bucket keyed by
+        the bucket's upper bound"""
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": {1 << index: count for index, count in enumerate(self.counts) if count},
+        }
+
+
+class LoopStats:
+    """Timings of a Connector's event loop, recorded when passed to the Connector.
+
+    Each iteration records the time spent waiting in select and the number of events it returned, and each
+    callback its duration, by type: accept, read, write, connect (connection complete), timer, wakeup (calls
+    from other threads) and other. Durations are in microseconds. Callbacks that take longer than
+    slow_callback seconds are counted, logged and the most recent kept for inspection.
+
+    snapshot may be called from any thread while the loop runs. Values from a running loop may be a few
+    events out of step with each other.
+    """
+
+    KINDS = ("accept", "read", "write", "connect", "timer", "wakeup", "other")
+
+    def __init__(self, slow_callback=0.1, recent_slow=20, clock=time.perf_counter):
+        """Arguments:
+        slow_callback -- seconds above which a callback is reported as slow
+        recent_slow -- number of slow callbacks kept for snapshot
+        clock -- function returning the time in seconds
+        """
+        self.clock = clock
+        self._slow_callback_us = int(slow_callback * 1e6)
+        self._recent_slow = recent_slow
+        self.reset()
+
+    def reset(self):
+        """Discard everything recorded so far"""
+        self.started = time.time()
+        self.iterations = 0
+        self.select_time = Histogram()
+        self.events = Histogram()
+        self.iteration_time = Histogram()
+        self.callbacks = {kind: Histogram() for kind in LoopStats.KINDS}
+        self.slow_callbacks = 0
+        self.recent_slow = collections.deque(maxlen=self._recent_slow)
+
+    def record_select(self, seconds, n_events):
+        self.select_time.add(int(seconds * 1e6))
+        self.events.add(n_events)
+
+    def record_iteration(self, seconds):
+        self.iterations += 1
+        self.iteration_time.add(int(seconds * 1e6))
+
+    def record(self, kind, seconds, source):
+        """Record a callback of type kind. source identifies it if it is slow"""
+        duration = int(seconds * 1e6)
+        self.callbacks[kind].add(duration)
+        if duration > self._slow_callback_us:
+            self.slow_callbacks += 1
+            description = LoopStats._describe(source)
+            self.recent_slow.append((time.time(), kind, duration, description))
+            logger.warning(f"Slow {kind} callback took {duration / 1000:.1f}ms: {description}")
+
+    @staticmethod
+    def _describe(source):
+        sockid = getattr(source, "sockid", None)
+        if sockid is not None:
+            return f"{type(source).__name__} {sockid()}"
+        return repr(source)
+
+    def snapshot(self):
+        """Return a dictionary of everything recorded since the stats were created or reset"""
+        return {
+            "seconds": time.time() - self.started,
+            "iterations": self.iterations,
+            "select_us": self.select_time.snapshot(),
+            "events_per_iteration": self.events.snapshot(),
+            "iteration_us": self.iteration_time.snapshot(),
+            "callback_us": {kind: histogram.snapshot() for kind, histogram in self.callbacks.items() if histogram.count},
+            "slow_callbacks": self.slow_callbacks,
+            "recent_slow": [
+                {"time": when, "kind": kind, "us": duration, "source": source}
+                for when, kind, duration, source in list(self.recent_slow)
+            ],
+        }
@@ -1,10 +1,16 @@
-import functools
+import fcntl
 import logging
+import os
 import selectors
 from errors import ProtocolError
+from send_queue import SendQueue
 
 logger = logging.getLogger(__name__)
 
+# os.splice is only available on Linux with Python 3.10 or later
+_HAS_SPLICE = hasattr(os, "splice")
+_SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+
 
 class ProtocolFactory:
     """Factory for Protocol objects. This class must be implemented to enable a server
@@ -14,14 +20,53 @@ class ProtocolFactory:
         """Return a Protocol instance"""
         pass
 
+    def overload_response(self):
+        """Return bytes to send to a connection turned away because the server is overloaded, or None"""
+        return None
+
+
+class _ProtocolState:
+    """Handlers for one Protocol state. Handlers are plain functions called with the Protocol instance,
+    so changing state is a single assignment that allocates nothing"""
+
+    __slots__ = ("write_handler", "writer", "reader", "closer", "reading")
+
+    def __init__(self, write_handler, writer, reader, closer, reading):
+        self.write_handler = write_handler  # Called when application wants to write data to the network
+        self.writer = writer                # Called to write to network
+        self.reader = reader                # Called to read from network
+        self.closer = closer                # Called to close network connection
+        self.reading = reading              # True if the socket should be read in this state
+
 
 class Protocol:
     """Handler for event driven networking. Manages reading and writing to the network.
 
-    Override on_connect, data_received and connection_lost to implement business logic
+    Override on_connect, data_received and connection_lost to implement business logic.
+    Protocol uses __slots__ to keep per connection memory small. Subclasses should declare
+    __slots__ for their own attributes.
     """
 
+    __slots__ = (
+        "_connector", "_selector", "_sock", "_local_addr", "_local_port", "_peer_addr", "_peer_port",
+        "_write_buffer", "_read_size", "_bytes_received", "_bytes_sent", "_write_buffer_high", "_write_buffer_low",
+        "_writing_paused", "_reading_paused", "_events", "_splice_pipe", "_splice_pending", "_splice_peer",
+        "_splice_source", "_state", "_on_failure", "_event_handler", "_connect_race",
+    )
+
+    # Initial size of each read from the network. The read size then adapts to the connection,
+    # doubling after a read fills the buffer and halving after a read uses less than a quarter of it,
+    # between MIN_READ_SIZE and the connector's max_read_size
     BUFSIZE = 8192
+    MIN_READ_SIZE = 2048
+
+    # Write buffer watermarks. pause_writing is called when buffered data rises above
+    # WRITE_BUFFER_HIGH and resume_writing once it has drained to WRITE_BUFFER_LOW
+    WRITE_BUFFER_HIGH = 262144
+    WRITE_BUFFER_LOW = 65536
+
+    # Size of the kernel pipe, and of each os.splice call, used by start_splice
+    SPLICE_SIZE = 262144
 
     def __init__(self):
         self._connector = None
@@ -31,11 +76,22 @@ class Protocol:
         self._local_port = 0
         self._peer_addr = ""
         self._peer_port = 0
-        self._write_buffer = bytearray()
-        self._write_handler = None  # Called when application wants to write data to the network
-        self._writer = None         # Called to write to network
-        self._reader = None         # Called to read from network
-        self._closer = None         # Called to close network connection
+        self._write_buffer = SendQueue()
+        self._read_size = self.BUFSIZE
+        self._bytes_received = 0
+        self._bytes_sent = 0
+        self._write_buffer_high = self.WRITE_BUFFER_HIGH
+        self._write_buffer_low = self.WRITE_BUFFER_LOW
+        self._writing_paused = False
+        self._reading_paused = False
+        self._events = None         # Selector events registered while connected. None if not connected
+        self._splice_pipe = None    # (read fd, write fd) of pipe carrying spliced data to be written to this socket
+        self._splice_pending = 0    # Number of bytes in _splice_pipe
+        self._splice_peer = None    # Protocol whose socket receives data spliced from this socket
+        self._splice_source = None  # Protocol whose socket feeds _splice_pipe
+        self._on_failure = None     # Called if connection setup fails
+        self._connect_race = None   # ConnectionRace connecting to one of several addresses
+        self._event_handler = self._handle_events  # Selector callback, bound once per connection
         self._set_unconnected()
 
     def on_connect(self):
@@ -47,6 +103,9 @@ class Protocol:
     def data_received(self, data):
         """Called when data is received from the network.
         Override this to implement your protocol
+
+        data is a memoryview of a pooled receive buffer that is reused once this method returns.
+        Copy it, e.g. with bytes(data), if it needs to be kept. Protocol.write takes its own copy.
         """
         pass
 
@@ -54,28 +113,100 @@ class Protocol:
         """Called when network connection has been closed."""
         pass
 
+    def pause_writing(self):
+        """Called when the write buffer rises above the high watermark.
+        Override this to stop producing data, e.g. by pausing reading on the connection that feeds this one
+        """
+        pass
+
+    def resume_writing(self):
+        """Called when the write buffer has drained to the low watermark after pause_writing"""
+        pass
+
     def write(self, data):
         """Buffers data for writing to network. You should not need to override this method.
         If you do, make sure you actually call it to write data to the network
         """
-        self._write_handler(data)
+        self._state.write_handler(self, data)
 
     def closing(self):
         """Signal connections should close after writing buffered data.
         If there is no data to write, the connection will be closed immediately"""
 
         logger.debug(f"{self.sockid()}:closing")
-        if len(self._write_buffer) == 0:
+        if self.get_write_buffer_size() == 0:
             # This will close socket and set handlers to closed state
-            self._closer(self._sock)
+            self._state.closer(self, self._sock)
         else:
             # Set handlers to closing state
             self._set_closing()
+            self._update_events()
 
     def close(self):
         """Closes connection immediately without writing buffered data"""
         logger.debug(f"{self.sockid()}:close")
-        self.closer(self._sock)
+        self._state.closer(self, self._sock)
+
+    def pause_reading(self):
+        """Stop reading from the network until resume_reading is called"""
+        if not self._reading_paused:
+            self._reading_paused = True
+            self._update_events()
+
+    def resume_reading(self):
+        """Start reading from the network again after pause_reading"""
+        if self._reading_paused:
+            self._reading_paused = False
+            self._update_events()
+
+    def set_write_buffer_limits(self, high, low=None):
+        """Set the write buffer watermarks used for flow control. low defaults to a quarter of high"""
+        if low is None:
+            low = high // 4
+        if not 0 <= low <= high:
+            raise ValueError(f"Invalid write buffer limits: high {high} low {low}")
+        self._write_buffer_high = high
+        self._write_buffer_low = low
+
+    def get_write_buffer_size(self):
+        """Return the number of bytes waiting to be written to the network"""
+        return len(self._write_buffer) + self._splice_pending
+
+    def start_splice(self, peer):
+        """Relay data received on this connection to peer's socket with os.splice.
+        Data moves socket to pipe to socket inside the kernel and is never copied into Python, so
+        data_received is no longer called. Data already buffered by peer.write is sent first.
+        Returns False, leaving the normal path in place, if splice is not available.
+        """
+        if not _HAS_SPLICE or self._state is not Protocol._CONNECTED or peer._events is None:
+            return False
+        try:
+            read_fd, write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError as e:
+            logger.debug(f"{self.sockid()}:start_splice:pipe error {e}")
+            return False
+        try:
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, self.SPLICE_SIZE)
+        except (AttributeError, OSError):
+            # Pipe keeps its default size
+            pass
+        logger.debug(f"{self.sockid()}:start_splice:to:{peer.sockid()}")
+        peer._splice_pipe = (read_fd, write_fd)
+        # Counted against the connector the peer closes the pipe on
+        peer._connector.pipe_fds += 2
+        peer._splice_source = self
+        self._splice_peer = peer
+        self._state = Protocol._SPLICING
+        return True
+
+    def stats(self):
+        """Return a dictionary of connection statistics"""
+        return {
+            "bytes_received": self._bytes_received,
+            "bytes_sent": self._bytes_sent,
+            "read_size": self._read_size,
+            "write_buffer_size": self.get_write_buffer_size(),
+        }
 
     def sockid(self):
         """Return socket identifier string """
@@ -92,26 +223,21 @@ class Protocol:
     def _set_unconnected(self):
         """Called when a socket is started or closed. Prevents any attempts to read or write data
         or to double close a socket"""
-        self._write_handler = self._null_write_handler
-        self._writer = self._null_network_handler
-        self._reader = self._null_network_handler
-        self._closer = self._null_closer
+        self._state = Protocol._UNCONNECTED
+
+    def _set_connecting(self):
+        """Called when a socket has been created. The writer checks whether the connection succeeded"""
+        self._state = Protocol._CONNECTING
 
     def _set_connected(self):
         """Called when socket is connected. Sets the read, write and close handlers to enable socket to be used"""
-        self._write_handler = self._connected_write_handler
-        self._writer = self._connected_writer
-        self._reader = self._connected_reader
-        self._closer = self._connected_closer
+        self._state = Protocol._CONNECTED
 
     def _set_closing(self):
         """Called when closing a socket.
         Sets the reader to a null function that prevents reading.
         Sets the writer to writer that will close once buffered data is written"""
-        self._write_handler = self._null_write_handler
-        self._writer = self._closing_writer
-        self._reader = self._null_network_handler
-        self._closer = self._connected_closer
+        self._state = Protocol._CLOSING
 
     def _connection_created(self, connector, selector, sock, on_failure=None):
         """Called when a new connection is created.
@@ -121,109 +247,298 @@ class Protocol:
         self._connector = connector
         self._selector = selector
         self._sock = sock
+        self._on_failure = on_failure
+        self._connect_race = None
+        connector.connections += 1
 
         logger.debug(f"{self.sockid()}:connection_created")
 
         # Wait for socket to become writable, at which point we can check for success
+        self._set_connecting()
         try:
-            self._selector.register(
-                self._sock,
-                selectors.EVENT_WRITE,
-                functools.partial(self._connection_complete, on_failure=on_failure)
-            )
+            self._selector.register(self._sock, selectors.EVENT_WRITE, self._event_handler)
         except (ValueError, KeyError)  as e:
             logger.debug(f"Selector registration error: {e}")
-            if on_failure is not None:
-                on_failure()
+            self._connection_failed(on_failure)
+
+    def _connection_racing(self, connector, race):
+        """Called when a ConnectionRace starts connecting to the addresses of a host. The race calls
+        _connection_created with the first socket to connect"""
+        self._connector = connector
+        self._connect_race = race
+        self._state = Protocol._RACING
 
-    def _connection_complete(self, sock, make, on_failure):
+    def _connection_complete(self, sock, mask):
         """Called once socket is writeable after it has been created.
         The socket could have connected, but it may have failed.
         A call to getpeername will detect if connection has failed.
         """
         logger.debug(f"{self.sockid()}:connection_complete")
+        on_failure = self._on_failure
+        self._on_failure = None
 
         # Check our socket has been created and that we are connected by checking peername
         if self._sock is not None:
             try:
-                (self._peer_addr, self._peer_port) = self._sock.getpeername()
-                (self._local_addr, self._local_port) = self._sock.getsockname()
+                # IPv6 addresses come with flow info and scope id as well
+                (self._peer_addr, self._peer_port) = self._sock.getpeername()[:2]
+                (self._local_addr, self._local_port) = self._sock.getsockname()[:2]
             except OSError as e:
                 logger.debug(f"Connection failed on name lookup: {e}")
-                if on_failure is not None:
-                    logger.debug(f"{self.sockid()}:calling on_failure")
-                    on_failure()
+                self._connection_failed(on_failure)
             else:
                 # Set handlers to deal with running connection
                 self._set_connected()
 
-                # Connected - call protocol custom setup code
-                self.on_connect()
-
-                # Register socket for reading
+                # Register socket for reading. This is done before on_connect so that any data
+                # written by on_connect can register for writing
                 try:
-                    self._selector.modify(self._sock, selectors.EVENT_READ, self._read)
+                    self._selector.modify(self._sock, selectors.EVENT_READ, self._event_handler)
                 except (ValueError, KeyError)  as e:
                     logger.debug(f"Selector registration error: {e}")
-                    if on_failure is not None:
-                        on_failure()
+                    self._connection_failed(on_failure)
+                else:
+                    self._events = selectors.EVENT_READ
+
+                    # Connected - call protocol custom setup code
+                    self.on_connect()
         else:
             logger.debug("Socket is none")
             if on_failure is not None:
                 on_failure()
 
+    def _connection_failed(self, on_failure):
+        """Called when connection setup fails. Releases the socket and calls on_failure"""
+        if on_failure is not None:
+            logger.debug(f"{self.sockid()}:calling on_failure")
+        try:
+            self._selector.unregister(self._sock)
+        except (ValueError, KeyError):
+            pass
+        self._sock.close()
+        self._connector.connections -= 1
+        self._set_unconnected()
+        if on_failure is not None:
+            on_failure()
+
     def _connected_write_handler(self, data):
-        """Called by application in connected state. Buffer data and wait for network"""
-        self._write_buffer.extend(data)
+        """Called by application in connected state.
+        Within a connector loop iteration, buffer data and ask the connector to flush it once all events
+        have been handled, so several writes go out in one system call.
+        Otherwise, if nothing is buffered, try to send straight away. Buffer whatever is left and wait for network"""
+        if len(self._write_buffer) > 0:
+            # Already waiting for the network to become writable, or for the connector to flush
+            self._write_buffer.append(data)
+            self._check_write_buffer_high()
+            return
+        if self._connector.coalescing:
+            self._write_buffer.append(data)
+            self._connector.schedule_flush(self)
+            self._check_write_buffer_high()
+            return
+        try:
+            n_bytes = self._sock.send(data)
+        except BlockingIOError:
+            n_bytes = 0
+        except OSError as e:
+            logger.debug(f"{self.sockid()}:_write:error{e}")
+            self._close(self._sock)
+            return
+        self._bytes_sent += n_bytes
+        if n_bytes == len(data):
+            return
+        self._write_buffer.append(memoryview(data)[n_bytes:])
+        self._update_events()
+        self._check_write_buffer_high()
+
+    def _flush(self):
+        """Called by the connector at the end of a loop iteration to write data buffered during the iteration"""
+        self._state.writer(self, self._sock, selectors.EVENT_WRITE)
+
+    def _check_write_buffer_high(self):
+        if not self._writing_paused and len(self._write_buffer) > self._write_buffer_high:
+            self._writing_paused = True
+            self.pause_writing()
+
+    def _check_write_buffer_low(self):
+        if self._writing_paused and self.get_write_buffer_size() <= self._write_buffer_low:
+            self._writing_paused = False
+            self.resume_writing()
+
+    def _update_events(self):
+        """Register for the network events needed by the current state.
+        Read interest is kept unless reading is paused or the connection is closing. Write interest is kept
+        while data is buffered. The selector is only called when the events change. With no events the
+        socket is removed from the selector.
+        """
+        if self._events is None:
+            return
+        events = 0
+        if not self._reading_paused and self._state.reading:
+            events |= selectors.EVENT_READ
+        if self.get_write_buffer_size() > 0:
+            events |= selectors.EVENT_WRITE
+        if events == self._events:
+            return
         try:
-            self._selector.modify(self._sock, selectors.EVENT_WRITE, self._write)
+            if events == 0:
+                self._selector.unregister(self._sock)
+            elif self._events == 0:
+                self._selector.register(self._sock, events, self._event_handler)
+            else:
+                self._selector.modify(self._sock, events, self._event_handler)
         except (ValueError, KeyError) as e:
             logger.debug(f"Selector registration error: {e}")
             self._close(self._sock)
+        else:
+            self._events = events
 
     def _null_write_handler(self, data):
         """Null function to handle write after a call to closing or when socket is closed. Do nothing"""
         pass
 
-    def _read(self, sock, mask):
-        """Called when socket is ready to be read"""
-        self._reader(sock, mask)
+    def _handle_events(self, sock, mask):
+        """Called when socket is ready. Buffered data is written before new data is read"""
+        if mask & selectors.EVENT_WRITE:
+            self._state.writer(self, sock, mask)
+        if mask & selectors.EVENT_READ:
+            self._state.reader(self, sock, mask)
 
     def _connected_reader(self, sock, mask):
-        """Called when socket is connected. Reads data from the network and calls data_received."""
-        try:
-            data = sock.recv(self.BUFSIZE)
-            if len(data) == 0:
+        """Called when socket is connected. Reads data from the network and calls data_received.
+        Keeps reading until the socket is drained or the connector's per iteration read budget is used,
+        so other connections get a turn. With a level triggered selector, a read that does not fill the buffer
+        means the socket is drained. An edge triggered selector gives no further event for an end of file that
+        arrived with the data already read, for example while reading was paused, so reading goes on until
+        the socket would block.
+        """
+        buffer_pool = self._connector.buffer_pool
+        budget = self._connector.read_budget
+        drained_on_short_read = not self._connector.edge_triggered
+        while True:
+            buf = buffer_pool.acquire(self._read_size)
+            read_size = min(self._read_size, len(buf))
+            try:
+                n_bytes = sock.recv_into(buf, read_size)
+                if n_bytes == 0:
+                    self._close(sock)
+                    return
+                self._bytes_received += n_bytes
+                if n_bytes == read_size:
+                    # Bulk transfer. Read more per wakeup
+                    self._read_size = min(read_size * 2, self._connector.max_read_size)
+                elif n_bytes * 4 < read_size:
+                    # Small messages. Don't tie up large buffers
+                    self._read_size = max(read_size // 2, self.MIN_READ_SIZE)
+                self.data_received(memoryview(buf)[:n_bytes])
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # Catch a 'Errno 104: connection reset by peer' if remote server resets
+                logger.debug(f"{sock.fileno()}:_read:error{e}")
                 self._close(sock)
-            else:
-                self.data_received(data)
-        except OSError as e:
-            # Catch a 'Errno 104: connection reset by peer' if remote server resets
-            logger.debug(f"{sock.fileno()}:_read:error{e}")
-            self._close(sock)
-
-    def _write(self, sock, mask):
-        """Called when socket is writable"""
-        self._writer(sock, mask)
+                return
+            finally:
+                buffer_pool.release(buf)
+            budget -= n_bytes
+            if (n_bytes < read_size and drained_on_short_read) or self._reading_paused or self._state is not Protocol._CONNECTED:
+                return
+            if budget <= 0:
+                self._read_budget_used()
+                return
+
+    def _read_budget_used(self):
+        """Called when a reader stops with data possibly left in the socket.
+        An edge triggered selector will not report the socket again, so ask the connector to continue next iteration"""
+        if self._connector.edge_triggered:
+            self._connector.schedule_read(self._continue_reading)
+
+    def _continue_reading(self):
+        """Called by the connector to carry on reading after _read_budget_used"""
+        if self._state.reading and not self._reading_paused:
+            self._state.reader(self, self._sock, selectors.EVENT_READ)
+
+    def _splice_reader(self, sock, mask):
+        """Reader used after start_splice. Moves data from the socket into the peer's pipe.
+        Like _connected_reader, keeps going until the socket is drained or the read budget is used"""
+        peer = self._splice_peer
+        budget = self._connector.read_budget
+        drained_on_short_read = not self._connector.edge_triggered
+        while True:
+            if peer._splice_pipe is None:
+                # Peer has closed
+                self._close(sock)
+                return
+            try:
+                n_bytes = os.splice(sock.fileno(), peer._splice_pipe[1], self.SPLICE_SIZE, flags=_SPLICE_FLAGS)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.debug(f"{sock.fileno()}:_splice_read:error{e}")
+                self._close(sock)
+                return
+            if n_bytes == 0:
+                self._close(sock)
+                return
+            self._bytes_received += n_bytes
+            peer._splice_pending += n_bytes
+            peer._splice_write()
+            budget -= n_bytes
+            if (n_bytes < self.SPLICE_SIZE and drained_on_short_read) or self._reading_paused \
+                    or self._state is not Protocol._SPLICING:
+                return
+            if budget <= 0:
+                self._read_budget_used()
+                return
+
+    def _splice_write(self):
+        """Called once the splice source has added data to the pipe. Writes as much as the socket will take.
+        If data is left in the pipe, stop reading the source until the pipe has been drained.
+        """
+        if len(self._write_buffer) == 0:
+            try:
+                self._splice_out(self._sock)
+            except OSError as e:
+                logger.debug(f"{self.sockid()}:_splice_write:error{e}")
+                self._close(self._sock)
+                return
+        if self._splice_pending > 0:
+            self._splice_source.pause_reading()
+            self._update_events()
+
+    def _splice_out(self, sock):
+        """Move data from the pipe to the socket until the pipe is empty or the socket is full"""
+        try:
+            while self._splice_pending > 0:
+                n_bytes = os.splice(self._splice_pipe[0], sock.fileno(), self._splice_pending, flags=_SPLICE_FLAGS)
+                self._splice_pending -= n_bytes
+                self._bytes_sent += n_bytes
+        except BlockingIOError:
+            pass
+        if self._splice_pending == 0 and self._splice_source is not None:
+            self._splice_source.resume_reading()
 
     def _connected_writer(self, sock, mask):
         """Writes data to the network when in a connected state"""
         try:
-            n_bytes = sock.send(self._write_buffer)
-            self._write_buffer = self._write_buffer[n_bytes:]
-            if len(self._write_buffer) == 0:
-                self._selector.modify(sock, selectors.EVENT_READ, self._read)
+            self._bytes_sent += self._write_buffer.send(sock)
+            if len(self._write_buffer) == 0 and self._splice_pending > 0:
+                self._splice_out(sock)
         except OSError as e:
             logger.debug(f"{sock.fileno()}:_write:error{e}")
             self._close(sock)
+        else:
+            self._update_events()
+            self._check_write_buffer_low()
 
     def _closing_writer(self, sock, mask):
         """Writes data to the network. Called once closing has been called.
         Closes socket when all buffered data is written"""
         try:
-            n_bytes = sock.send(self._write_buffer)
-            self._write_buffer = self._write_buffer[n_bytes:]
-            if len(self._write_buffer) == 0:
+            self._bytes_sent += self._write_buffer.send(sock)
+            if len(self._write_buffer) == 0 and self._splice_pending > 0:
+                self._splice_out(sock)
+            if self.get_write_buffer_size() == 0:
                 self._close(sock)
         except OSError as e:
             logger.debug(f"{sock.fileno()}:_write:error{e}")
@@ -234,23 +549,54 @@ class Protocol:
         pass
 
     def _close(self, sock):
-        self._closer(sock)
+        self._state.closer(self, sock)
 
     def _connected_closer(self, sock):
         """Called when in connected or closing state.
         Close network connection and call connection_lost."""
         logger.debug(f"{sock.fileno()}:_close")
         try:
-            self._selector.unregister(sock)
+            if self._events != 0:
+                self._selector.unregister(sock)
         except ValueError as e:
             logging.debug("Invalid socket id - already closed")
         except KeyError as e:
             logging.debug("Socket not registered")
         sock.close()
+        self._connector.connections -= 1
+        self._write_buffer.clear()
+        if self._splice_pipe is not None:
+            os.close(self._splice_pipe[0])
+            os.close(self._splice_pipe[1])
+            self._connector.pipe_fds -= 2
+            self._splice_pipe = None
+            self._splice_pending = 0
+        self._events = None
+        self._writing_paused = False
         self._set_unconnected()
         self.connection_lost()
 
+    def _connecting_closer(self, sock):
+        """Called when closing before the connection is complete, for example on a connect timeout.
+        Abandons the connection and calls on_failure"""
+        on_failure = self._on_failure
+        self._on_failure = None
+        self._connection_failed(on_failure)
+
+    def _racing_closer(self, sock):
+        """Called when closing while connection attempts are racing. Stops them and calls on_failure"""
+        race = self._connect_race
+        self._connect_race = None
+        race.close()
+
     def _null_closer(self, sock):
         """Called when socket has already been closed. Prevents multiple close errors"""
         pass
 
+    _UNCONNECTED = _ProtocolState(_null_write_handler, _null_network_handler, _null_network_handler, _null_closer, False)
+    _RACING = _ProtocolState(_null_write_handler, _null_network_handler, _null_network_handler, _racing_closer, False)
+    _CONNECTING = _ProtocolState(_null_write_handler, _connection_complete, _null_network_handler, _connecting_closer, False)
+    _CONNECTED = _ProtocolState(_connected_write_handler, _connected_writer, _connected_reader, _connected_closer, True)
+    _SPLICING = _ProtocolState(_connected_write_handler, _connected_writer, _splice_reader, _connected_closer, True)
+    _CLOSING = _ProtocolState(_null_write_handler, _closing_writer, _null_network_handler, _connected_closer, False)
+
@@ -10,6 +10,8 @@ class RemoteServerProtocol(Protocol):
     Protocol is configured with a client_protocol to enable data received from
     the remote server to be written to the client.
     """
+
+    __slots__ = ("_client_protocol",)
     def __init__(self, client_protocol):
         Protocol.__init__(self)
         self._client_protocol = client_protocol
@@ -25,6 +27,13 @@ class RemoteServerProtocol(Protocol):
         # Data received from the remote connection is written to the client connection
         self._client_protocol.write(data)
 
+    def pause_writing(self):
+        # Remote server is not keeping up with the client. Stop reading from the client until it catches up
+        self._client_protocol.pause_reading()
+
+    def resume_writing(self):
+        self._client_protocol.resume_reading()
+
     def connection_lost(self):
         logger.debug(f"connection_lost")
         self._client_protocol.closing()
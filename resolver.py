@@ -0,0 +1,146 @@
+import logging
+import queue
+import socket
+import threading
+import time
+from dns_cache import DnsCache
+
+logger = logging.getLogger(__name__)
+
+
+class ResolverPool:
+    """Fixed number of threads running blocking getaddrinfo calls, fed from a bounded queue.
+
+    A burst of lookups waits in the queue rather than starting a thread each, so the number of threads and
+    the memory they use stay fixed. When the queue is full new lookups are rejected straight away, failing
+    the request that needed them, rather than queueing behind lookups whose clients may already have given
+    up. Threads are started on the first lookup. One pool can be shared by several Connectors.
+    With a DnsCache, results are cached and callers check cached before submitting a lookup.
+
+    Lookups of a name already queued or running are not queued again. Their callbacks are added to the
+    lookup in flight and all are called with its result, so lookups scale with distinct names rather than
+    with the connections asking for them.
+    """
+
+    def __init__(self, n_threads=32, max_queue=4096, cache=None):
+        """Arguments:
+        n_threads -- number of lookups run at once
+        max_queue -- most lookups waiting for a thread. Further lookups are rejected
+        cache -- a DnsCache to store results in. None for no caching
+        """
+        self.cache = cache
+        self._n_threads = n_threads
+        self._queue = queue.Queue(max_queue)
+        self._threads = []
+        self._in_flight = {}        # Name queued or being looked up -> callbacks waiting for it
+        self._lock = threading.Lock()
+        self._full = False          # True from a rejected lookup until the next one is queued, to log once
+        self.submitted = 0          # Number of lookups queued
+        self.coalesced = 0          # Number of lookups that joined one already in flight
+        self.rejected = 0           # Number of lookups rejected because the queue was full
+        self.completed = 0          # Number of lookups finished, successfully or not
+        self.failed = 0             # Number of lookups that found no address
+        self.max_queue_depth = 0    # Most lookups seen waiting at once
+        self.lookup_time = 0.0      # Total seconds spent in getaddrinfo
+
+    def submit(self, hostname, callback):
+        """Queue a lookup of hostname, or join the lookup in flight for the same name. callback is called on a
+        pool thread with the list of addresses, in the order getaddrinfo prefers them, empty if the lookup
+        failed. Returns False, without calling callback, if the queue is full. May be called from any thread"""
+        if len(self._threads) < self._n_threads:
+            self._start_threads()
+        key = DnsCache.normalize(hostname)
+        with self._lock:
+            callbacks = self._in_flight.get(key)
+            if callbacks is not None:
+                callbacks.append(callback)
+                self.coalesced += 1
+                return True
+            try:
+                self._queue.put_nowait(key)
+            except queue.Full:
+                self.rejected += 1
+                if not self._full:
+                    self._full = True
+                    logger.warning("Resolver queue full: rejecting lookups")
+                return False
+            self._in_flight[key] = [callback]
+            self._full = False
+            self.submitted += 1
+            depth = self._queue.qsize()
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+        return True
+
+    def cached(self, hostname):
+        """Return the cached addresses of hostname, None if its lookup failed recently, or DnsCache.MISS.
+        May be called from any thread"""
+        if self.cache is None:
+            return DnsCache.MISS
+        return self.cache.get(hostname)
+
+    def queue_depth(self):
+        """Number of lookups waiting for a thread"""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Return a dictionary of pool statistics"""
+        with self._lock:
+            stats = {
+                "threads": len(self._threads),
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._in_flight),
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "mean_lookup_ms": self.lookup_time * 1000 / self.completed if self.completed else 0,
+            }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def _start_threads(self):
+        with self._lock:
+            while len(self._threads) < self._n_threads:
+                thread = threading.Thread(target=self._run, name=f"resolver-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    @staticmethod
+    def lookup(hostname):
+        """Return the IPv6 and IPv4 addresses of hostname, once each, in the order getaddrinfo sorts them
+        (RFC 6724), which puts addresses the host can reach first. Blocks"""
+        addresses = []
+        for family, _, _, _, sockaddr in socket.getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP):
+            if family in (socket.AF_INET, socket.AF_INET6) and sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses
+
+    def _run(self):
+        while True:
+            hostname = self._queue.get()
+            start = time.monotonic()
+            try:
+                addresses = ResolverPool.lookup(hostname)
+            except (OSError, UnicodeError) as e:
+                logger.debug(f"Lookup of {hostname} failed: {e}")
+                addresses = []
+            elapsed = time.monotonic() - start
+            # Cache the result before leaving the in flight list, so a request for the name made between the
+            # two finds one or the other
+            if self.cache is not None:
+                self.cache.put(hostname, addresses or None)
+            with self._lock:
+                callbacks = self._in_flight.pop(hostname)
+                self.completed += 1
+                self.lookup_time += elapsed
+                if not addresses:
+                    self.failed += 1
+            for callback in callbacks:
+                try:
+                    callback(addresses)
+                except Exception:
+                    logger.exception(f"Lookup callback for {hostname} failed")
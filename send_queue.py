@@ -0,0 +1,87 @@
+import collections
+import itertools
+import socket
+
+
+class SendQueue:
+    """Queue of buffers waiting to be written to a socket.
+
+    Data is held as a list of memoryview chunks. Sending uses scatter-gather (sendmsg) so
+    several chunks go out in one system call, and a partial send only moves the offset into
+    the first chunk. Bytes already in the queue are never copied again.
+    """
+
+    __slots__ = ("_chunks", "_offset", "_size")
+
+    # Maximum number of chunks passed to a single sendmsg call. Must be below IOV_MAX (1024 on Linux)
+    MAX_IOV = 64
+
+    def __init__(self):
+        self._chunks = None     # Deque of chunks. Only allocated while data is queued
+        self._offset = 0        # Number of bytes of the first chunk already sent
+        self._size = 0          # Number of bytes waiting to be sent
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        """Add data to the end of the queue.
+        Immutable bytes are queued without copying. Other buffers may be changed by the caller
+        once this returns, so they are copied once on the way in.
+        """
+        if len(data) == 0:
+            return
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if self._chunks is None:
+            self._chunks = collections.deque()
+        self._chunks.append(memoryview(data))
+        self._size += len(data)
+
+    def clear(self):
+        self._chunks = None
+        self._offset = 0
+        self._size = 0
+
+    def send(self, sock):
+        """Send as much queued data as the socket will take. Returns the number of bytes sent.
+        Keeps sending until the queue is empty or the socket is full. OSError other than
+        BlockingIOError is passed on to the caller.
+        """
+        sent = 0
+        try:
+            while self._size > 0:
+                chunks = self._chunks
+                if len(chunks) == 1 or not _HAS_SENDMSG:
+                    buffer = chunks[0][self._offset:]
+                    offered = len(buffer)
+                    n_bytes = sock.send(buffer)
+                else:
+                    buffers = list(itertools.islice(chunks, SendQueue.MAX_IOV))
+                    buffers[0] = buffers[0][self._offset:]
+                    offered = self._size if len(chunks) <= SendQueue.MAX_IOV else sum(map(len, buffers))
+                    n_bytes = sock.sendmsg(buffers)
+                self._consume(n_bytes)
+                sent += n_bytes
+                if n_bytes < offered:
+                    # Socket buffer is full
+                    break
+        except BlockingIOError:
+            pass
+        return sent
+
+    def _consume(self, n_bytes):
+        """Drop n_bytes from the front of the queue"""
+        self._size -= n_bytes
+        n_bytes += self._offset
+        chunks = self._chunks
+        while chunks and n_bytes >= len(chunks[0]):
+            n_bytes -= len(chunks.popleft())
+        if chunks:
+            self._offset = n_bytes
+        else:
+            self._chunks = None
+            self._offset = 0
+
+
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
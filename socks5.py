@@ -82,14 +82,14 @@ class Socks5:
         ulen = data[Socks5.AUTH_ULEN_INDEX]
         if len(data) < Socks5.AUTH_ULEN_INDEX+1+ulen:
             raise ProtocolError(f"Username too small")
-        username = data[(Socks5.AUTH_ULEN_INDEX+1):(Socks5.AUTH_ULEN_INDEX+1+ulen)]
+        username = bytes(data[(Socks5.AUTH_ULEN_INDEX+1):(Socks5.AUTH_ULEN_INDEX+1+ulen)])
         plen_index = Socks5.AUTH_ULEN_INDEX+1+ulen
         if len(data) < plen_index:
             raise ProtocolError(f"Password too small")
         plen = data[plen_index]
         if len(data) < plen_index+1+plen:
             raise ProtocolError(f"Password too small")
-        password = data[(plen_index+1):(plen_index+1+plen)]
+        password = bytes(data[(plen_index+1):(plen_index+1+plen)])
         return username, password
 
     @staticmethod
@@ -106,16 +106,23 @@ class Socks5:
         #TODO - remove magic numbers from this section
         addr_type = data[Socks5.ADDRESS_INDEX]
         if addr_type == Socks5.ADDRESS_IPV4:
+            if len(data) < 10:
+                raise ProtocolError(f"IPv4 connection request too small {len(data)} < 10")
             addr = str(ip_address(int.from_bytes(data[4:8], byteorder="big", signed=False)))
             port = int.from_bytes(data[8:10], byteorder="big", signed=False)
             return addr, port, Socks5.ADDRESS_IPV4
         elif addr_type == Socks5.ADDRESS_DOMAIN:
             alen = data[4]
-            addr = data[5:5+alen].decode('ascii')
+            if len(data) < 7+alen:
+                raise ProtocolError(f"Domain connection request too small {len(data)} < {7+alen}")
+            addr = bytes(data[5:5+alen]).decode('ascii')
             port = int.from_bytes(data[5+alen:7+alen], byteorder="big", signed=False)
             return addr, port, Socks5.ADDRESS_DOMAIN
         elif addr_type == Socks5.ADDRESS_IPV6:
-            addr = str(ip_address(int.from_bytes(data[4:20], byteorder="big", signed=False)))
+            if len(data) < 22:
+                raise ProtocolError(f"IPv6 connection request too small {len(data)} < 22")
+            # From the bytes rather than an integer, which ip_address would take as IPv4 for addresses below 2**32
+            addr = str(ipaddress.IPv6Address(bytes(data[4:20])))
             port = int.from_bytes(data[20:22], byteorder="big", signed=False)
             return addr, port, Socks5.ADDRESS_IPV6
         else:
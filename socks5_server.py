@@ -9,38 +9,114 @@ logger = logging.getLogger(__name__)
 
 
 class Socks5ProtocolFactory(ProtocolFactory):
+    """Creates Socks5Protocol instances. Timeouts are in seconds. None disables a timeout"""
 
-    def __init__(self, authenticator):
+    def __init__(self, authenticator, splice=False, handshake_timeout=None, connect_timeout=None, idle_timeout=None):
         self._authenticator = authenticator
+        self._splice = splice
+        self._handshake_timeout = handshake_timeout
+        self._connect_timeout = connect_timeout
+        self._idle_timeout = idle_timeout
 
     def create(self):
-        return Socks5Protocol(self._authenticator)
+        return Socks5Protocol(self._authenticator, self._splice,
+                              self._handshake_timeout, self._connect_timeout, self._idle_timeout)
+
+    def overload_response(self):
+        # Greeting reply accepting none of the client's methods, which SOCKS clients treat as a failure
+        return Socks5.greeting_response(Socks5.NO_METHOD)
 
 
 class Socks5Protocol(Protocol):
 
+    __slots__ = (
+        "_authenticator", "_splice", "_data_received_handler", "_remote_server_protocol",
+        "_handshake_timeout", "_connect_timeout", "_idle_timeout", "_timer", "_idle_bytes",
+    )
+
     conn_logger = logging.getLogger("ConnectionLogger")
 
-    def __init__(self, authenticator):
+    def __init__(self, authenticator, splice=False, handshake_timeout=None, connect_timeout=None, idle_timeout=None):
         Protocol.__init__(self)
         # Username / password authenticator
         self._authenticator = authenticator
 
-        # Function that handles incoming data. This changes as protocol progresses
-        self._data_received_handler = self._client_greeting
+        # Relay tunnel data with os.splice once the remote connection is made
+        self._splice = splice
+
+        # Seconds allowed for the client to send its connection request, for the remote connection to be made,
+        # and for a tunnel to pass no data. None for no limit
+        self._handshake_timeout = handshake_timeout
+        self._connect_timeout = connect_timeout
+        self._idle_timeout = idle_timeout
+
+        # Timer for the current timeout, and bytes moved when the idle timer was set
+        self._timer = None
+        self._idle_bytes = 0
+
+        # Function that handles incoming data. This changes as protocol progresses.
+        # Handlers are stored unbound and called with self so that changing handler allocates nothing
+        self._data_received_handler = Socks5Protocol._client_greeting
 
         # Connection to remote host
         self._remote_server_protocol = None
 
+    def on_connect(self):
+        self._set_timer(self._handshake_timeout, self._handshake_timed_out)
+
     def data_received(self, data):
         # Incoming data is just passed to the current handler
-        self._data_received_handler(data)
+        self._data_received_handler(self, data)
 
     def connection_lost(self):
         logger.debug(f"connection_lost")
+        self._set_timer(None, None)
         if self._remote_server_protocol is not None:
             self._remote_server_protocol.closing()
 
+    def pause_writing(self):
+        # Client is not keeping up with the remote server. Stop reading from the remote server until it catches up
+        if self._remote_server_protocol is not None:
+            self._remote_server_protocol.pause_reading()
+
+    def resume_writing(self):
+        if self._remote_server_protocol is not None:
+            self._remote_server_protocol.resume_reading()
+
+    def _set_timer(self, timeout, callback):
+        """Cancel the current timer, then call callback after timeout seconds unless timeout is None"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if timeout is not None:
+            self._timer = self._connector.call_later(timeout, callback)
+
+    def _handshake_timed_out(self):
+        logger.info(f"{self.sockid()}:handshake timed out")
+        self._timer = None
+        self.close()
+
+    def _connect_timed_out(self):
+        logger.info(f"{self.sockid()}:remote connection timed out")
+        self._timer = None
+        if self._remote_server_protocol is None:
+            # Still looking up the host name
+            self.remote_connection_failure()
+        else:
+            # Abandons the connection attempt, which calls remote_connection_failure
+            self._remote_server_protocol.close()
+
+    def _check_idle(self):
+        """Close the tunnel if no data has moved in either direction since the timer was set"""
+        self._timer = None
+        n_bytes = self._bytes_received + self._bytes_sent
+        if n_bytes == self._idle_bytes:
+            logger.info(f"{self.sockid()}:idle timeout")
+            self.close()
+        else:
+            self._idle_bytes = n_bytes
+            self._set_timer(self._idle_timeout, self._check_idle)
+
     def _client_greeting(self, data):
         logger.debug(f"{self.sockid()}:client_greeting")
         try:
@@ -52,10 +128,10 @@ class Socks5Protocol(Protocol):
                 self.closing()
             elif auth_method == Socks5.NO_AUTH:
                 logger.debug(f"{self.sockid()}:client_greeting:no auth")
-                self._data_received_handler = self._parse_client_connection_request
+                self._data_received_handler = Socks5Protocol._parse_client_connection_request
             elif auth_method == Socks5.USER_PWD:
                 logger.debug(f"{self.sockid()}:client_greeting:username password")
-                self._data_received_handler = self._username_password_authentication
+                self._data_received_handler = Socks5Protocol._username_password_authentication
         except ProtocolError as e:
             logger.warning(f"{self.sockid()}:Error parsing client greeting: {e}")
             self.close()
@@ -67,7 +143,7 @@ class Socks5Protocol(Protocol):
             if self._authenticator.authenticate(username=username, password=password):
                 logger.debug(f"{self.sockid()}:username_password_authentication:success")
                 self.write(Socks5.authentication_success())
-                self._data_received_handler = self._parse_client_connection_request
+                self._data_received_handler = Socks5Protocol._parse_client_connection_request
             else:
                 logger.debug(f"{self.sockid()}:username_password_authentication:failure")
                 self.write(Socks5.authentication_failure())
@@ -79,11 +155,15 @@ class Socks5Protocol(Protocol):
     def _parse_client_connection_request(self, data):
         try:
             remote_addr, remote_port, addr_type = Socks5.parse_connection_request(data)
+            # The handshake is over. The connect timeout covers looking up the host name as well as connecting,
+            # so a slow lookup gets a failure reply rather than the connection being dropped
+            self._set_timer(self._connect_timeout, self._connect_timed_out)
             if addr_type == Socks5.ADDRESS_DOMAIN:
-                # Call gethostbyname on connector, passing in callback once complete, to stop blocking other connections
-                self._connector.gethostbyname(
+                # Call getaddrinfo on connector, passing in callback once complete, to stop blocking other connections
+                self._data_received_handler = Socks5Protocol._null_data_received_handler
+                self._connector.getaddrinfo(
                     remote_addr,
-                    functools.partial(self._make_client_connection_request, remote_port=remote_port, hostname=remote_addr)
+                    functools.partial(self._hostname_resolved, remote_port=remote_port, hostname=remote_addr)
                 )
             elif addr_type == Socks5.ADDRESS_IPV4:
                 if remote_addr == "0.0.0.0":
@@ -93,12 +173,23 @@ class Socks5Protocol(Protocol):
                 else:
                     self._make_client_connection_request(remote_addr=remote_addr, remote_port=remote_port)
             else:
-                logger.debug("parse_client_connection_request:IPv6:unsupported")
-                self.remote_connection_failure()
+                self._make_client_connection_request(remote_addr=remote_addr, remote_port=remote_port)
         except ProtocolError as e:
             logger.warning(f"{self.sockid()}:Error parsing connection request: {e}")
             self.close()
 
+    def _hostname_resolved(self, remote_addr, remote_port, hostname):
+        """Called on the loop thread once getaddrinfo completes. remote_addr is the list of addresses found,
+        empty if the lookup failed. create_client races connections to them"""
+        if self._state is not Protocol._CONNECTED:
+            # Client closed, or timed out, during the lookup
+            return
+        if not remote_addr:
+            logger.debug(f"{self.sockid()}:hostname_resolved:{hostname}:lookup failed")
+            self.remote_connection_failure()
+        else:
+            self._make_client_connection_request(remote_addr=remote_addr, remote_port=remote_port, hostname=hostname)
+
     def _make_client_connection_request(self, remote_addr, remote_port, hostname="UNKNOWN"):
         client_addr, client_port = self.peer_connection_params()
         logger.debug(f"{self.sockid()}:make_client_connection_request:hostname:{hostname}:addr:{remote_addr}:port:{remote_port}")
@@ -109,12 +200,13 @@ class Socks5Protocol(Protocol):
             self._remote_server_protocol,
             self.remote_connection_failure
         )
-        self._data_received_handler = self._null_data_received_handler
+        self._data_received_handler = Socks5Protocol._null_data_received_handler
 
     def remote_connection_failure(self):
         # Get here via a failure of remote connection.
         # Need to return failure condition and close
         logger.debug(f"{self.sockid()}:remote_connection_failure")
+        self._set_timer(None, None)
         addr, port = self.local_connection_params()
         self.write(Socks5.connection_failure(addr, port))
         self.closing()
@@ -124,7 +216,13 @@ class Socks5Protocol(Protocol):
         logger.debug(f"{self.sockid()}:remote_connection_success")
         addr, port = self.local_connection_params()
         self.write(Socks5.connection_success(addr, port))
-        self._data_received_handler = self._proxy_data
+        self._data_received_handler = Socks5Protocol._proxy_data
+        self._idle_bytes = self._bytes_received + self._bytes_sent
+        self._set_timer(self._idle_timeout, self._check_idle)
+        if self._splice:
+            # Falls back to _proxy_data in any direction where splice is unavailable
+            self.start_splice(self._remote_server_protocol)
+            self._remote_server_protocol.start_splice(self)
 
     def _null_data_received_handler(self, data):
         # This should never be called as we should only be in this state when
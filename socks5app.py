@@ -1,9 +1,22 @@
 import logging
 import argparse
+import ipaddress
+import json
+import signal
+import socket
+from admission import AdmissionControl
+from asyncio_connector import AsyncioConnector
 from authenticator import Authenticator
 from connector import Connector
+from dns_cache import DnsCache
+from dns_client import DnsClient
+from loop_group import LoopGroup
+from loop_stats import LoopStats
+from resolver import ResolverPool
 from errors import AuthenticatorError
+from handoff import Handoff
 from socks5_server import Socks5ProtocolFactory
+from supervisor import Supervisor
 
 logger = logging.getLogger(__name__)
 
@@ -20,13 +33,96 @@ def configure_connection_logger():
     conn_logger.addHandler(conn_handler)
 
 
+def nameserver(value):
+    """Parse a --nameserver argument: an IPv4 or IPv6 address, optionally with a port as 1.2.3.4:53 or [::1]:53"""
+    if value.startswith("["):
+        addr, _, port = value[1:].partition("]")
+        port = port.lstrip(":")
+    elif value.count(":") == 1:
+        addr, _, port = value.partition(":")
+    else:
+        addr, port = value, ""
+    try:
+        return str(ipaddress.ip_address(addr)), int(port) if port else 53
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid nameserver: {value}")
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="Socks5 Proxy.")
     parser.add_argument("--password_file", default="password_file")
     parser.add_argument("--loglevel", default="WARN", help="DEBUG, INFO, WARNING or ERROR")
     parser.add_argument("--port", type=int, default=1080)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of event loop threads in each process (free threaded Python only)")
+    parser.add_argument("--backend", choices=Connector.BACKENDS + AsyncioConnector.BACKENDS, default="selectors",
+                        help="selectors, epoll for edge triggered epoll (Linux only), asyncio, or uvloop if installed")
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN, help="Length of the listen queue")
+    parser.add_argument("--accept_batch", type=int, default=64,
+                        help="Most connections accepted in one event loop iteration")
+    parser.add_argument("--admission", choices=("off", "pause", "shed"), default="pause",
+                        help="When near the file descriptor limit, pause accepting, or shed connections with a fast "
+                             "SOCKS failure (selectors and epoll backends)")
+    parser.add_argument("--fd_reserve", type=int, default=64,
+                        help="File descriptors kept free for upstream connections when admitting clients")
+    parser.add_argument("--max_read_size", type=int, default=262144, help="Largest read from a socket in bytes")
+    parser.add_argument("--read_budget", type=int, default=262144,
+                        help="Most bytes read from one connection before serving the next")
+    parser.add_argument("--no_write_coalescing", action="store_true",
+                        help="Write data immediately rather than at the end of each event loop iteration")
+    parser.add_argument("--splice", action="store_true", help="Relay tunnel data with os.splice (Linux only)")
+    parser.add_argument("--handshake_timeout", type=float, default=10.0,
+                        help="Seconds allowed for a client to send its connection request. 0 for no limit")
+    parser.add_argument("--connect_timeout", type=float, default=10.0,
+                        help="Seconds allowed to look up and connect to the remote server. 0 for no limit")
+    parser.add_argument("--idle_timeout", type=float, default=600.0,
+                        help="Seconds a tunnel may pass no data before it is closed. 0 for no limit")
+    parser.add_argument("--handoff_socket",
+                        help="UNIX socket path. A new proxy started with the same path takes over the listening "
+                             "socket while this one drains its tunnels")
+    parser.add_argument("--drain_timeout", type=float, default=60.0,
+                        help="Most seconds to wait for tunnels to close after handing off the listening socket")
+    parser.add_argument("--loop_stats", action="store_true",
+                        help="Record event loop timings. SIGUSR1 logs them (selectors and epoll backends)")
+    parser.add_argument("--slow_callback", type=float, default=100.0,
+                        help="Milliseconds above which an event loop callback is logged as slow, with --loop_stats")
+    parser.add_argument("--resolver_threads", type=int, default=32,
+                        help="Number of threads looking up host names, shared by the event loops of each process")
+    parser.add_argument("--resolver_queue", type=int, default=4096,
+                        help="Most host name lookups waiting for a thread, or per event loop for the native "
+                             "resolver. Requests beyond this fail at once")
+    parser.add_argument("--dns_cache_size", type=int, default=10000,
+                        help="Most host names kept in the lookup cache. 0 to disable the cache")
+    parser.add_argument("--dns_ttl", type=float, default=60.0, help="Seconds to cache a host name's address")
+    parser.add_argument("--dns_negative_ttl", type=float, default=5.0,
+                        help="Seconds to cache a failed host name lookup. 0 to not cache failures")
+    parser.add_argument("--resolver", choices=("threads", "native"), default="threads",
+                        help="Look up host names with getaddrinfo in the resolver threads, or with a DNS client on "
+                             "the event loop that ignores resolv.conf search domains. The asyncio backends always "
+                             "use threads")
+    parser.add_argument("--nameserver", type=nameserver, action="append",
+                        help="DNS server for the native resolver, as ADDRESS or ADDRESS:PORT. May be repeated. "
+                             "Defaults to the nameservers in /etc/resolv.conf")
+    parser.add_argument("--connect_attempt_delay", type=float, default=250.0,
+                        help="Milliseconds to wait for a connection to one address of a host before also trying the "
+                             "next")
     args = parser.parse_args()
+    if args.backend in AsyncioConnector.BACKENDS:
+        if args.threads > 1:
+            parser.error(f"--threads is not supported by the {args.backend} backend")
+        if args.splice:
+            parser.error(f"--splice is not supported by the {args.backend} backend")
+        args.admission = "off"
+        args.resolver = "threads"
+        if args.loop_stats:
+            parser.error(f"--loop_stats is not supported by the {args.backend} backend")
+        if args.handoff_socket:
+            parser.error(f"--handoff_socket is not supported by the {args.backend} backend")
+    if args.handoff_socket and args.workers > 1:
+        parser.error("--handoff_socket is not supported with --workers")
 
     configure_connection_logger()
 
@@ -48,9 +144,64 @@ def main():
         logger.error(e)
         exit()
 
-    connector = Connector()
-    connector.create_server('0.0.0.0', args.port, Socks5ProtocolFactory(authenticator))
-    connector.start()
+    def create_connector(resolver):
+        if args.backend in AsyncioConnector.BACKENDS:
+            return AsyncioConnector(backend=args.backend, resolver=resolver,
+                                    connect_attempt_delay=args.connect_attempt_delay / 1000)
+        loop_stats = LoopStats(slow_callback=args.slow_callback / 1000) if args.loop_stats else None
+        connector = Connector(max_read_size=args.max_read_size, coalesce_writes=not args.no_write_coalescing,
+                              read_budget=args.read_budget, backend=args.backend, accept_batch=args.accept_batch,
+                              loop_stats=loop_stats, resolver=resolver,
+                              connect_attempt_delay=args.connect_attempt_delay / 1000)
+        if args.resolver == "native":
+            connector.dns_client = DnsClient(connector, nameservers=args.nameserver, cache=resolver.cache,
+                                             max_queue=args.resolver_queue)
+        return connector
+
+    def log_stats(index, connector):
+        logger.warning(f"Loop {index} stats: {json.dumps(connector.stats())}")
+
+    def request_stats(loops):
+        # Each loop reports from its own thread
+        def handler(signum, frame):
+            for index, connector in enumerate(loops.loops):
+                connector.call_soon_threadsafe(log_stats, index, connector)
+        signal.signal(signal.SIGUSR1, handler)
+
+    def run_worker():
+        dns_cache = None
+        if args.dns_cache_size > 0:
+            dns_cache = DnsCache(max_entries=args.dns_cache_size, ttl=args.dns_ttl, negative_ttl=args.dns_negative_ttl)
+        resolver = ResolverPool(n_threads=args.resolver_threads, max_queue=args.resolver_queue, cache=dns_cache)
+        loops = LoopGroup(args.threads, lambda: create_connector(resolver))
+        request_stats(loops)
+        protocol_factory = Socks5ProtocolFactory(
+            authenticator, args.splice,
+            handshake_timeout=args.handshake_timeout or None,
+            connect_timeout=args.connect_timeout or None,
+            idle_timeout=args.idle_timeout or None,
+        )
+        admission = None
+        if args.admission != "off":
+            admission = AdmissionControl(fds_per_connection=6 if args.splice else 2, reserve=args.fd_reserve,
+                                         shed=args.admission == "shed")
+        handoff = None
+        listener = None
+        if args.handoff_socket:
+            handoff = Handoff(args.handoff_socket, args.drain_timeout)
+            listeners = handoff.take_over()
+            if listeners:
+                listener = listeners[0]
+        listener = loops.create_server('0.0.0.0', args.port, protocol_factory, reuse_port=args.workers > 1,
+                                       backlog=args.backlog, admission=admission, sock=listener)
+        if handoff is not None:
+            handoff.serve(loops.loops, [listener])
+        loops.start()
+
+    if args.workers > 1:
+        Supervisor(args.workers, run_worker).run()
+    else:
+        run_worker()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,48 @@
+import os
+import socket
+import struct
+import threading
+from dns_client import DnsMessage
+
+
+def free_port():
+    """Return a TCP port on 127.0.0.1 that is free now"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_dns_server(port, ttl=300, drop=0.0):
+    """Start a stand-in DNS server on UDP port, in a thread, for tests and benchmarks. Names ending .test
+    resolve to 127.0.0.1, with an AAAA record of ::1, and other names do not exist. drop is the fraction of
+    queries ignored. Returns a dictionary counting the queries received and dropped"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", port))
+    counters = {"queries": 0, "dropped": 0}
+
+    def serve():
+        while True:
+            query, addr = server.recvfrom(512)
+            counters["queries"] += 1
+            if drop and int.from_bytes(os.urandom(2), "big") < drop * 65536:
+                counters["dropped"] += 1
+                continue
+            query_id = struct.unpack_from("!H", query)[0]
+            name, offset = DnsMessage.decode_name(query, DnsMessage.HEADER.size)
+            qtype = DnsMessage.QUESTION.unpack_from(query, offset)[0]
+            question = query[DnsMessage.HEADER.size:offset + DnsMessage.QUESTION.size]
+            answers = b""
+            rcode = DnsMessage.RCODE_NOERROR
+            if not name.endswith(".test"):
+                rcode = DnsMessage.RCODE_NXDOMAIN
+            elif qtype == DnsMessage.TYPE_A:
+                answers = struct.pack("!HHHIH", 0xC00C, qtype, DnsMessage.CLASS_IN, ttl, 4) + socket.inet_aton("127.0.0.1")
+            elif qtype == DnsMessage.TYPE_AAAA:
+                answers = struct.pack("!HHHIH", 0xC00C, qtype, DnsMessage.CLASS_IN, ttl, 16) \
+                    + socket.inet_pton(socket.AF_INET6, "::1")
+            flags = DnsMessage.FLAG_RESPONSE | DnsMessage.FLAG_RECURSION_DESIRED | 0x0080 | rcode
+            header = DnsMessage.HEADER.pack(query_id, flags, 1, 1 if answers else 0, 0, 0)
+            server.sendto(header + question + answers, addr)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return counters
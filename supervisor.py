@@ -0,0 +1,81 @@
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """Runs worker_main in n_workers forked processes (POSIX only).
+
+    Workers that exit while the supervisor is running are restarted. SIGINT, SIGTERM, SIGHUP and SIGUSR1
+    received by the supervisor are forwarded to every worker. SIGINT and SIGTERM also stop the
+    supervisor once all workers have exited. Workers do not handle SIGHUP, so it restarts them.
+    """
+
+    SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1)
+
+    # Workers that exit sooner than this after starting are restarted after a delay, to avoid a fork loop
+    MIN_UPTIME = 1.0
+    RESTART_DELAY = 1.0
+
+    def __init__(self, n_workers, worker_main):
+        self._n_workers = n_workers
+        self._worker_main = worker_main
+        self._workers = {}      # pid -> start time
+        self._stopping = False
+
+    def run(self):
+        """Start the workers and supervise them until stopped by a signal"""
+        for signum in Supervisor.SIGNALS:
+            signal.signal(signum, self._forward_signal)
+        for _ in range(self._n_workers):
+            self._start_worker()
+
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self._workers.pop(pid, None)
+            if started is None:
+                continue
+            if self._stopping:
+                logger.debug(f"Worker {pid} exited")
+                continue
+            logger.warning(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}. Restarting")
+            if time.monotonic() - started < Supervisor.MIN_UPTIME:
+                time.sleep(Supervisor.RESTART_DELAY)
+            if not self._stopping:
+                self._start_worker()
+
+    def _start_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            # Worker process. Restore default signal handling and never return to the supervisor
+            for signum in Supervisor.SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            status = 0
+            try:
+                self._worker_main()
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logger.exception("Worker failed")
+                status = 1
+            finally:
+                logging.shutdown()
+                os._exit(status)
+        logger.debug(f"Started worker {pid}")
+        self._workers[pid] = time.monotonic()
+
+    def _forward_signal(self, signum, frame):
+        if signum in (signal.SIGINT, signal.SIGTERM):
+            self._stopping = True
+        for pid in self._workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
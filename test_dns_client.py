@@ -0,0 +1,332 @@
+"""Tests for DnsClient, run on a Connector against the stand-in DNS server in stand_in_dns.py and against
+scripted servers that send crafted responses. Run with python -m pytest"""
+import socket
+import struct
+import threading
+import time
+import pytest
+from connector import Connector
+from dns_cache import DnsCache
+from dns_client import DnsClient, DnsMessage
+from errors import ProtocolError
+from stand_in_dns import free_port, start_dns_server
+
+
+def _record(name_offset, rtype, ttl, rdata):
+    return struct.pack("!HHHIH", 0xC000 | name_offset, rtype, DnsMessage.CLASS_IN, ttl, len(rdata)) + rdata
+
+
+def _response(query, rcode=DnsMessage.RCODE_NOERROR, answers=(), query_id=None, question=None):
+    """Return a response to query with answers, raw records. The question and ID are copied from the
+    query unless given"""
+    name, offset = DnsMessage.decode_name(query, DnsMessage.HEADER.size)
+    if query_id is None:
+        query_id = struct.unpack_from("!H", query)[0]
+    if question is None:
+        question = query[DnsMessage.HEADER.size:offset + DnsMessage.QUESTION.size]
+    flags = DnsMessage.FLAG_RESPONSE | DnsMessage.FLAG_RECURSION_DESIRED | 0x0080 | rcode
+    return DnsMessage.HEADER.pack(query_id, flags, 1, len(answers), 0, 0) + question + b"".join(answers)
+
+
+def _address_record(qtype, ttl=300):
+    """A or AAAA record for the question name, which starts at offset 12"""
+    if qtype == DnsMessage.TYPE_A:
+        return _record(12, qtype, ttl, socket.inet_aton("127.0.0.1"))
+    return _record(12, qtype, ttl, socket.inet_pton(socket.AF_INET6, "::1"))
+
+
+def _scripted_server(handle):
+    """Start a DNS server calling handle(sock, query, addr, qtype) for each query. Returns its port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+
+    def serve():
+        while True:
+            query, addr = sock.recvfrom(512)
+            offset = DnsMessage.decode_name(query, DnsMessage.HEADER.size)[1]
+            handle(sock, query, addr, DnsMessage.QUESTION.unpack_from(query, offset)[0])
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def _client(ports, timeout=0.5, attempts=2, cache=None, hosts=None, **kwargs):
+    connector = Connector()
+    connector.dns_client = DnsClient(connector, nameservers=[("127.0.0.1", port) for port in ports],
+                                     timeout=timeout, attempts=attempts, cache=cache,
+                                     hosts={} if hosts is None else hosts, **kwargs)
+    return connector
+
+
+def _lookup(connector, hostname, limit=5.0):
+    """Run the connector's loop until getaddrinfo of hostname answers. Returns the addresses"""
+    results = []
+    connector.getaddrinfo(hostname, results.append)
+    deadline = time.monotonic() + limit
+    while not results and time.monotonic() < deadline:
+        connector.run_once(timeout=0.05)
+    assert results, f"No answer for {hostname}"
+    return results[0]
+
+
+@pytest.fixture
+def stand_in():
+    port = free_port()
+    return port, start_dns_server(port, ttl=30)
+
+
+def test_encode_query_round_trip():
+    message = DnsMessage.encode_query(0x1234, "Example.test.", DnsMessage.TYPE_AAAA)
+    assert struct.unpack_from("!H", message)[0] == 0x1234
+    name, offset = DnsMessage.decode_name(message, DnsMessage.HEADER.size)
+    assert name == "example.test"
+    assert DnsMessage.QUESTION.unpack_from(message, offset) == (DnsMessage.TYPE_AAAA, DnsMessage.CLASS_IN)
+
+
+def test_encode_name_rejects_long_labels():
+    with pytest.raises(ProtocolError):
+        DnsMessage.encode_name("a" * 64 + ".test")
+
+
+def test_decode_name_compression_loop():
+    # A pointer to itself
+    with pytest.raises(ProtocolError):
+        DnsMessage.decode_name(b"\xc0\x00", 0)
+
+
+def test_decode_name_past_end():
+    with pytest.raises(ProtocolError):
+        DnsMessage.decode_name(b"\x05ab", 0)
+
+
+def test_parse_response_truncated_record():
+    query = DnsMessage.encode_query(1, "host.test", DnsMessage.TYPE_A)
+    response = _response(query, answers=[_address_record(DnsMessage.TYPE_A)])
+    with pytest.raises(ProtocolError):
+        DnsMessage.parse_response(response[:-2])
+
+
+def test_parse_response_rejects_queries():
+    with pytest.raises(ProtocolError):
+        DnsMessage.parse_response(DnsMessage.encode_query(1, "host.test", DnsMessage.TYPE_A))
+
+
+def test_addresses_follow_cname_with_lowest_ttl():
+    answers = [
+        ("www.test", DnsMessage.TYPE_CNAME, 60, "host.test"),
+        ("host.test", DnsMessage.TYPE_A, 300, "127.0.0.1"),
+        ("host.test", DnsMessage.TYPE_A, 200, "127.0.0.2"),
+        ("other.test", DnsMessage.TYPE_A, 10, "127.0.0.3"),
+    ]
+    assert DnsMessage.addresses("www.test", DnsMessage.TYPE_A, answers) == (["127.0.0.1", "127.0.0.2"], 60)
+    assert DnsMessage.addresses("www.test", DnsMessage.TYPE_AAAA, answers) == ([], 60)
+
+
+def test_cname_loop_ends():
+    answers = [("a.test", DnsMessage.TYPE_CNAME, 60, "b.test"), ("b.test", DnsMessage.TYPE_CNAME, 60, "a.test")]
+    assert DnsMessage.addresses("a.test", DnsMessage.TYPE_A, answers)[0] == []
+
+
+def test_getaddrinfo(stand_in):
+    port, server = stand_in
+    cache = DnsCache()
+    connector = _client([port], cache=cache)
+    assert _lookup(connector, "Host.test") == ["::1", "127.0.0.1"]
+    assert server["queries"] == 2
+    # Answered from the cache
+    assert _lookup(connector, "host.test.") == ["::1", "127.0.0.1"]
+    assert server["queries"] == 2
+    assert connector.connections == 0
+    connector.shutdown()
+
+
+def test_name_not_found_is_cached(stand_in):
+    port, server = stand_in
+    cache = DnsCache()
+    connector = _client([port], cache=cache)
+    assert _lookup(connector, "missing.example") == []
+    assert _lookup(connector, "missing.example") == []
+    assert server["queries"] == 2
+    assert cache.stats()["negative_hits"] == 1
+    connector.shutdown()
+
+
+def test_hosts_and_literals_need_no_query(stand_in):
+    port, server = stand_in
+    connector = _client([port], hosts={"box.test": ["10.0.0.1", "fd00::1"]})
+    assert _lookup(connector, "BOX.test") == ["fd00::1", "10.0.0.1"]
+    assert _lookup(connector, "192.0.2.1") == ["192.0.2.1"]
+    assert _lookup(connector, "2001:db8::1") == ["2001:db8::1"]
+    assert server["queries"] == 0
+    connector.shutdown()
+
+
+def test_concurrent_lookups_share_queries(stand_in):
+    port, server = stand_in
+    connector = _client([port])
+    results = []
+    for _ in range(5):
+        connector.getaddrinfo("same.test", results.append)
+    while len(results) < 5:
+        connector.run_once(timeout=0.05)
+    assert results == [["::1", "127.0.0.1"]] * 5
+    assert server["queries"] == 2
+    connector.shutdown()
+
+
+def test_max_in_flight_queues_the_rest(stand_in):
+    port, server = stand_in
+    # Two lookups, so four queries
+    connector = _client([port], max_in_flight=2)
+    results = []
+    for i in range(20):
+        connector.getaddrinfo(f"host{i}.test", results.append)
+    stats = connector.dns_client.stats()
+    assert stats["in_flight"] == 4
+    assert stats["waiting"] == 36
+    assert connector.connections == 4
+    while len(results) < 20:
+        connector.run_once(timeout=0.05)
+    assert all(addresses == ["::1", "127.0.0.1"] for addresses in results)
+    assert connector.dns_client.stats()["waiting"] == 0
+    assert connector.connections == 0
+    connector.shutdown()
+
+
+def test_max_queue_rejects(stand_in):
+    port, server = stand_in
+    connector = _client([port], max_in_flight=1, max_queue=1)
+    results = []
+    for i in range(3):
+        connector.getaddrinfo(f"host{i}.test", results.append)
+    # The limits count lookups: the first is sent, the second waits and both queries of the third are rejected
+    assert connector.dns_client.stats()["rejected"] == 2
+    while len(results) < 3:
+        connector.run_once(timeout=0.05)
+    assert results.count([]) == 1
+    connector.shutdown()
+
+
+def test_servfail_tries_next_server(stand_in):
+    port, server = stand_in
+
+    def servfail(sock, query, addr, qtype):
+        sock.sendto(_response(query, rcode=DnsMessage.RCODE_SERVFAIL), addr)
+
+    connector = _client([_scripted_server(servfail), port], timeout=5)
+    start = time.monotonic()
+    assert _lookup(connector, "host.test") == ["::1", "127.0.0.1"]
+    # Not left waiting for the retransmit timer
+    assert time.monotonic() - start < 1
+    assert connector.dns_client.stats()["retransmits"] == 2
+    connector.shutdown()
+
+
+def test_mismatched_responses_are_ignored():
+    def mismatched(sock, query, addr, qtype):
+        query_id = struct.unpack_from("!H", query)[0]
+        other_question = DnsMessage.encode_name("other.test") + DnsMessage.QUESTION.pack(qtype, DnsMessage.CLASS_IN)
+        wrong_type = DnsMessage.TYPE_A if qtype == DnsMessage.TYPE_AAAA else DnsMessage.TYPE_AAAA
+        sock.sendto(_response(query, answers=[_address_record(qtype)], query_id=query_id ^ 1), addr)
+        sock.sendto(_response(query, answers=[_address_record(qtype)], question=other_question), addr)
+        sock.sendto(_response(query, question=DnsMessage.encode_name("host.test")
+                              + DnsMessage.QUESTION.pack(wrong_type, DnsMessage.CLASS_IN)), addr)
+        sock.sendto(b"\x00" * 5, addr)
+        sock.sendto(_response(query, answers=[_address_record(qtype, ttl=100)]), addr)
+
+    cache = DnsCache()
+    connector = _client([_scripted_server(mismatched)], cache=cache)
+    assert _lookup(connector, "host.test") == ["::1", "127.0.0.1"]
+    assert connector.dns_client.stats()["retransmits"] == 0
+    connector.shutdown()
+
+
+def test_responses_from_another_source_are_ignored():
+    spoofer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def other_source(sock, query, addr, qtype):
+        spoofer.sendto(_response(query, answers=[_address_record(qtype)]), addr)
+
+    connector = _client([_scripted_server(other_source)], timeout=0.2, attempts=1)
+    assert _lookup(connector, "host.test") == []
+    assert connector.dns_client.stats()["timeouts"] == 2
+    connector.shutdown()
+    spoofer.close()
+
+
+def test_each_query_uses_a_new_port():
+    ports = []
+
+    def record_port(sock, query, addr, qtype):
+        ports.append(addr[1])
+
+    connector = _client([_scripted_server(record_port)], timeout=0.1, attempts=3)
+    assert _lookup(connector, "host.test") == []
+    # Two queries, each sent three times
+    assert len(ports) == 6
+    assert len(set(ports)) == 6
+    assert connector.connections == 0
+    connector.shutdown()
+
+
+def test_retransmit_after_drop():
+    seen = set()
+
+    def drop_first(sock, query, addr, qtype):
+        if qtype not in seen:
+            seen.add(qtype)
+            return
+        sock.sendto(_response(query, answers=[_address_record(qtype)]), addr)
+
+    connector = _client([_scripted_server(drop_first)], timeout=0.1)
+    assert _lookup(connector, "host.test") == ["::1", "127.0.0.1"]
+    assert connector.dns_client.stats()["retransmits"] == 2
+    connector.shutdown()
+
+
+def test_resolution_delay_gives_up_on_slow_aaaa():
+    def slow_aaaa(sock, query, addr, qtype):
+        if qtype == DnsMessage.TYPE_AAAA:
+            threading.Timer(1.0, sock.sendto, (_response(query, answers=[_address_record(qtype)]), addr)).start()
+        else:
+            sock.sendto(_response(query, answers=[_address_record(qtype)]), addr)
+
+    cache = DnsCache()
+    connector = _client([_scripted_server(slow_aaaa)], timeout=5, cache=cache)
+    start = time.monotonic()
+    assert _lookup(connector, "host.test") == ["127.0.0.1"]
+    assert time.monotonic() - start < 0.5
+    assert connector.dns_client.stats()["resolution_delays"] == 1
+    # A partial answer is not cached
+    assert len(cache) == 0
+    connector.shutdown()
+
+
+def test_aaaa_answer_is_used_without_waiting_for_a():
+    def aaaa_only(sock, query, addr, qtype):
+        if qtype == DnsMessage.TYPE_AAAA:
+            sock.sendto(_response(query, answers=[_address_record(qtype)]), addr)
+
+    cache = DnsCache()
+    connector = _client([_scripted_server(aaaa_only)], timeout=1, attempts=2, cache=cache)
+    start = time.monotonic()
+    assert _lookup(connector, "host.test") == ["::1"]
+    assert time.monotonic() - start < 0.5
+    assert len(cache) == 0
+    connector.shutdown()
+
+
+def test_ttl_is_lowest_of_records():
+    def ttls(sock, query, addr, qtype):
+        sock.sendto(_response(query, answers=[_address_record(qtype, ttl=7 if qtype == DnsMessage.TYPE_A else 90)]),
+                    addr)
+
+    now = [1000.0]
+    cache = DnsCache(clock=lambda: now[0])
+    connector = _client([_scripted_server(ttls)], cache=cache)
+    assert _lookup(connector, "host.test") == ["::1", "127.0.0.1"]
+    now[0] += 6
+    assert cache.get("host.test") == ["::1", "127.0.0.1"]
+    now[0] += 2
+    assert cache.get("host.test") is DnsCache.MISS
+    connector.shutdown()
@@ -0,0 +1,104 @@
+import math
+import time
+
+
+class Timer:
+    """Handle for a callback scheduled with TimerWheel.call_later"""
+
+    __slots__ = ("_wheel", "expiry", "callback", "args")
+
+    def __init__(self, wheel, expiry, callback, args):
+        self._wheel = wheel         # None once the timer has fired or been cancelled
+        self.expiry = expiry        # Tick at which the timer fires
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        """Stop the callback being called. Does nothing if it has already been called or cancelled"""
+        if self._wheel is not None:
+            self._wheel._cancel(self)
+
+
+class TimerWheel:
+    """Hashed timing wheel for connection timeouts.
+
+    Time is divided into ticks and each timer is put in the slot for its expiry tick, modulo the number of
+    slots, so call_later and cancel are O(1) however many timers are waiting. Timers further away than one
+    turn of the wheel share a slot with nearer ones and are skipped until their tick comes round.
+    Timers fire on the first tick at or after their deadline, so up to one tick late.
+    The wheel is not thread safe. Each Connector has its own, used from its event loop.
+    """
+
+    def __init__(self, tick=0.1, n_slots=512, clock=time.monotonic):
+        """Arguments:
+        tick -- resolution of the wheel in seconds
+        n_slots -- number of slots. One turn of the wheel is tick * n_slots seconds
+        clock -- function returning the time in seconds
+        """
+        self._tick = tick
+        self._clock = clock
+        self._slots = [set() for _ in range(n_slots)]
+        self._current = int(clock() / tick)     # Last tick processed by advance
+        self._next = math.inf                   # No timer expires before this tick
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds. Returns a Timer that can be cancelled"""
+        expiry = max(math.ceil((self._clock() + delay) / self._tick), self._current + 1)
+        timer = Timer(self, expiry, callback, args)
+        self._slots[expiry % len(self._slots)].add(timer)
+        self._count += 1
+        if expiry < self._next:
+            self._next = expiry
+        return timer
+
+    def _cancel(self, timer):
+        self._slots[timer.expiry % len(self._slots)].discard(timer)
+        timer._wheel = None
+        self._count -= 1
+
+    def timeout(self):
+        """Seconds until a timer may next expire, for use as a select timeout. None if there are no timers"""
+        if self._count == 0:
+            return None
+        return max(self._next * self._tick - self._clock(), 0)
+
+    def advance(self, call=None):
+        """Call the callbacks of timers that have expired.
+        call, if given, is called as call(callback, args) to run each one, for example to time it"""
+        now = int(self._clock() / self._tick)
+        if now <= self._current:
+            return
+        n_slots = len(self._slots)
+        # After a wait longer than one turn, every slot is visited once
+        first = max(self._current + 1, now - n_slots + 1)
+        self._current = now
+        if self._count == 0 or self._next > now:
+            return
+        for tick in range(first, now + 1):
+            slot = self._slots[tick % n_slots]
+            if slot:
+                expired = [timer for timer in slot if timer.expiry <= now]
+                for timer in expired:
+                    if timer._wheel is None:
+                        # Cancelled by the callback of a timer that fired before it
+                        continue
+                    self._cancel(timer)
+                    if call is None:
+                        timer.callback(*timer.args)
+                    else:
+                        call(timer.callback, timer.args)
+        self._next = self._find_next()
+
+    def _find_next(self):
+        """Return the first tick after the current one with a timer in its slot"""
+        if self._count == 0:
+            return math.inf
+        n_slots = len(self._slots)
+        for tick in range(self._current + 1, self._current + n_slots + 1):
+            if self._slots[tick % n_slots]:
+                return tick
+        return math.inf
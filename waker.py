@@ -0,0 +1,56 @@
+import os
+import socket
+
+
+class Waker:
+    """Wakes an event loop from another thread.
+
+    Register the Waker for reading in the loop's selector. wake makes it readable and drain, called on the
+    loop thread, resets it. Uses an eventfd on Linux, one descriptor whose counter absorbs any number of
+    wakes, and a non-blocking socket pair elsewhere.
+    """
+
+    def __init__(self):
+        if hasattr(os, "eventfd"):
+            self._read_fd = self._write_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._sockets = None
+        else:
+            self._sockets = socket.socketpair()
+            for sock in self._sockets:
+                sock.setblocking(False)
+            self._read_fd = self._sockets[0].fileno()
+            self._write_fd = self._sockets[1].fileno()
+
+    def fileno(self):
+        return self._read_fd
+
+    def wake(self):
+        """Make the waker readable. May be called from any thread"""
+        try:
+            if self._sockets is None:
+                os.eventfd_write(self._write_fd, 1)
+            else:
+                os.write(self._write_fd, b"\0")
+        except BlockingIOError:
+            # Socket pair is full, so the loop is already due to wake
+            pass
+
+    def drain(self):
+        """Clear pending wakes. Called on the loop thread once the waker is readable"""
+        try:
+            if self._sockets is None:
+                os.eventfd_read(self._read_fd)
+            else:
+                while os.read(self._read_fd, 4096):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self._sockets is None:
+            if self._read_fd >= 0:
+                os.close(self._read_fd)
+                self._read_fd = self._write_fd = -1
+        else:
+            for sock in self._sockets:
+                sock.close()